@@ -3,16 +3,20 @@
 """rdimage.py module description."""
 
 import argparse
+import concurrent.futures
+import csv
 import functools
-import glob
+import itertools
+import math
 import os
 import os.path
 import pathlib
+import re
+import string
 import sys
 
 import utils
 
-
 CODEC_INFO = {
     "jpeg/libjpeg-turbo": {
         "format": "jpeg",
@@ -57,6 +61,51 @@ CODEC_INFO = {
         "output_format": ".avif",
     },
 }
+
+
+def compile_command(template):
+    # pre-split a str.format()-style template into (literal, field) pairs
+    return [
+        (literal, field) for literal, field, _, _ in string.Formatter().parse(template)
+    ]
+
+
+def render_command(compiled, values):
+    return "".join(
+        literal + ("" if field is None else str(values[field]))
+        for literal, field in compiled
+    )
+
+
+# command templates are parsed once, at import time
+COMPILED_COMMANDS = {
+    (codec, key): compile_command(info[key])
+    for codec, info in CODEC_INFO.items()
+    for key in ("encode_command", "decode_command")
+    if key in info
+}
+# input files with these (known non-media) extensions are skipped
+# without probing them (any other file is probed)
+NON_MEDIA_EXTENSIONS = {
+    ".csv",
+    ".db",
+    ".gz",
+    ".html",
+    ".json",
+    ".log",
+    ".md",
+    ".pdf",
+    ".pkl",
+    ".py",
+    ".sh",
+    ".sqlite",
+    ".tar",
+    ".txt",
+    ".xml",
+    ".yaml",
+    ".yml",
+    ".zip",
+}
 JPEG_QUALITY_LIST = list(range(0, 101, 20))
 JXL_QUALITY_LIST = list(range(10, 101, 20))
 HEIC_QUALITY_LIST = list(range(0, 101, 20))
@@ -73,11 +122,14 @@ HEIC_PRESET_LIST = [
     "placebo",
 ]
 AVIF_SPEED_LIST = list(range(0, 11, 2))
+# list-based options can be separated by ',' and/or whitespace
+LIST_SEPARATOR = re.compile(r"[,\s]+")
 
 default_values = {
     "debug": 0,
     "nruns": 10,
     "cleanup": True,
+    "jobs": os.cpu_count(),
     "tmp_dir": "/tmp/",
     "vmaf_dir": "/tmp/",
     "codecs": list(CODEC_INFO.keys()),
@@ -91,13 +143,20 @@ default_values = {
 }
 
 
+# iterative version (explicit stack) of the classic recursive flatten
 # https://stackabuse.com/python-how-to-flatten-list-of-lists/
 def flatten(the_list):
-    if len(the_list) == 0:
-        return the_list
-    if isinstance(the_list[0], list) or isinstance(the_list[0], tuple):
-        return flatten(the_list[0]) + flatten(the_list[1:])
-    return the_list[:1] + flatten(the_list[1:])
+    stack = [iter(the_list)]
+    while stack:
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(item, (list, tuple)):
+            stack.append(iter(item))
+        else:
+            yield item
 
 
 def is_media_file(fname, tmp_dir="/tmp", debug=0):
@@ -110,6 +169,121 @@ def is_media_file(fname, tmp_dir="/tmp", debug=0):
     return retcode == 0
 
 
+def probe_media_file(fname, tmp_dir, debug):
+    # check whether the file is a media file
+    if not is_media_file(fname, tmp_dir, debug):
+        return None
+    resolution = utils.get_resolution(fname, debug)
+    numpixels = math.prod(int(val) for val in resolution.split("x"))
+    return resolution, numpixels
+
+
+def convert_input_file(orig_infile, input_format, tmp_dir, debug):
+    # adapt input file to the encoder requirements
+    # extensions are case-insensitive (e.g. "foo.PPM" needs no conversion)
+    infile_format = os.path.splitext(orig_infile)[1].lower()
+    if infile_format == input_format:
+        return orig_infile
+    infile = os.path.join(tmp_dir, os.path.basename(orig_infile) + input_format)
+    ffmpeg_params = ["-y", "-i", orig_infile, infile]
+    retcode, stdout, stderr, _ = utils.ffmpeg_run(ffmpeg_params, debug)
+    assert (
+        retcode == 0
+    ), f"error converting {orig_infile} to {infile}\nstdout: {stdout}\nstderr: {stderr}"
+    return infile
+
+
+def run_single_experiment(
+    orig_infile,
+    infile,
+    in_basename,
+    infilesize,
+    resolution,
+    numpixels,
+    parameter_vals,
+    parameter_name_list,
+    options,
+):
+    parameter_dict = {k: v for k, v in zip(parameter_name_list, parameter_vals)}
+    if options.debug > 0:
+        print(f"-- infile: {orig_infile} parameters: {parameter_dict}")
+    codec = parameter_dict["codec"]
+    # 4.0. prepare the encode command
+    # get the output file postfix
+    postfix = ""
+    for name, val in zip(parameter_name_list, parameter_vals):
+        if val != "":
+            # parameter is being used
+            postfix += f".{name}_{val}"
+    # escape postfix
+    postfix = postfix.replace("/", "_")
+    input_format = CODEC_INFO[codec]["input_format"]
+    # get the output file with the right type
+    output_format = CODEC_INFO[codec]["output_format"]
+    outfile = os.path.join(
+        options.tmp_dir,
+        in_basename + postfix + output_format,
+    )
+    cmd = render_command(
+        COMPILED_COMMANDS[(codec, "encode_command")],
+        {**parameter_dict, "infile": infile, "outfile": outfile},
+    )
+    # 4.1. run the encode command
+    # TODO(chema): implement nruns
+    retcode, stdout, stderr, perf_stats = utils.run(
+        cmd, debug=options.debug, get_perf_stats=True
+    )
+    if (
+        retcode != 0
+        and b"Svt[error]" in stderr
+        and b"8k+ resolution support is limited to M8" in stderr
+    ):
+        # TODO(chema): fix this
+        # svt has issues with 8k+ resolution support based on the preset
+        return None, perf_stats
+    assert (
+        retcode == 0
+    ), f"error encoding video file\ncmd: {cmd}\nstdout: {stdout}\nstderr: {stderr}"
+    # outresolution = utils.get_resolution(outfile)
+    # assert resolution == outresolution, f"error: resolution change\n  {infile}: {resolution}\n  {outfile}: {outresolution}"
+    outfilesize = os.path.getsize(outfile)
+    inbpp = (8 * infilesize) / numpixels
+    outbpp = (8 * outfilesize) / numpixels
+    ratiobpp = outbpp / inbpp
+    # 4.2. decode the file (if needed)
+    decode_command = COMPILED_COMMANDS.get((codec, "decode_command"), None)
+    if decode_command is None:
+        distorted_infile = outfile
+    else:
+        distorted_infile = outfile + input_format
+        cmd = render_command(
+            decode_command, {"infile": outfile, "outfile": distorted_infile}
+        )
+        retcode, stdout, stderr, _ = utils.run(cmd, debug=options.debug)
+        assert (
+            retcode == 0
+        ), f"error decoding video file\ncmd: {cmd}\nstdout: {stdout}\nstderr: {stderr}"
+    # 4.3. calculate the quality score(s)
+    psnr, ssim, vmaf = utils.get_metrics(distorted_infile, infile, options.debug)
+    # 4.4. store results
+    local_results = (
+        [codec, in_basename, resolution]
+        + parameter_vals[1:]
+        + [
+            infilesize,
+            inbpp,
+            outfilesize,
+            outbpp,
+            ratiobpp,
+            psnr,
+            ssim,
+            vmaf,
+        ]
+        + list(perf_stats.values())
+    )
+    return local_results, perf_stats
+
+
 def run_experiment(options):
     # check all software is ok
     utils.check_software(options.debug)
@@ -118,151 +292,126 @@ def run_experiment(options):
     pathlib.Path(options.tmp_dir).mkdir(parents=True, exist_ok=True)
 
     # 1. get list of input files
-    infile_list = []
-    for fname in glob.glob(f"{options.indir}/*"):
-        # check whether the file is a media file
-        if is_media_file(fname, options.tmp_dir, options.debug):
-            infile_list.append(fname)
+    # skip known non-media files by extension before probing them
+    fname_list = []
+    for entry in os.scandir(options.indir):
+        if not entry.is_file():
+            continue
+        if os.path.splitext(entry.name)[1].lower() in NON_MEDIA_EXTENSIONS:
+            if options.debug > 0:
+                print(f"warning: skipping {entry.path} as no-media file")
+            continue
+        fname_list.append(entry.path)
+    # format conversions keep the resolution, so probe each input file once
+    resolution_cache = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        probe_list = executor.map(
+            probe_media_file,
+            fname_list,
+            itertools.repeat(options.tmp_dir),
+            itertools.repeat(options.debug),
+        )
+        for fname, probe in zip(fname_list, probe_list):
+            if probe is not None:
+                resolution_cache[fname] = probe
+    infile_list = list(resolution_cache.keys())
 
     # 2. get all the possible combinations of input parameters
     parameter_name_list = [
         "codec",
-    ] + list(set(flatten([v["parameters"] for v in CODEC_INFO.values()])))
+    ] + list(dict.fromkeys(flatten([v["parameters"] for v in CODEC_INFO.values()])))
     parameter_val_list = []
     for codec in options.codecs:
-        tmp_parameter_val_list = [
-            codec,
-        ]
         # develop all the possible combinations of parameters
-        for parameter in parameter_name_list[1:]:
-            value_list = (
+        value_list_list = [
+            (
                 vars(options)[parameter]
                 if parameter in CODEC_INFO[codec]["parameters"]
                 else [
                     "",
                 ]
             )
-            tmp_parameter_val_list = list(
-                [x, y] for x in tmp_parameter_val_list for y in value_list
-            )
-        # flatten the resulting parameter list
-        tmp_parameter_val_list = [flatten(l) for l in tmp_parameter_val_list]
-        parameter_val_list += tmp_parameter_val_list
+            for parameter in parameter_name_list[1:]
+        ]
+        for value_list in itertools.product(*value_list_list):
+            parameter_val_list.append([codec, *value_list])
 
-    # 3. run each experiment
-    results = []
+    # 3. convert the input files to the formats required by the encoders
+    # (once per input file and format, not once per experiment)
+    input_format_set = {CODEC_INFO[codec]["input_format"] for codec in options.codecs}
+    converted = {}
     for orig_infile in infile_list:
-        for parameter_vals in parameter_val_list:
-            parameter_dict = {k: v for k, v in zip(parameter_name_list, parameter_vals)}
-            if options.debug > 0:
-                print(f"-- infile: {orig_infile} parameters: {parameter_dict}")
-            codec = parameter_dict["codec"]
-            # 3.0. prepare the encode command
-            # adapt input file to the encoder requirements
-            input_format = CODEC_INFO[codec]["input_format"]
-            infile_format = os.path.splitext(os.path.basename(orig_infile))[1]
-            if input_format == infile_format:
-                infile = orig_infile
-            else:
-                infile = os.path.join(
-                    options.tmp_dir,
-                    os.path.basename(orig_infile) + input_format,
-                )
-                ffmpeg_params = ["-y", "-i", orig_infile, infile]
-                retcode, stdout, stderr, _ = utils.ffmpeg_run(
-                    ffmpeg_params, options.debug
-                )
-                assert (
-                    retcode == 0
-                ), f"error converting {orig_infile} to {infile}\nstdout: {stdout}\nstderr: {stderr}"
-            # get the output file with the right type
-            postfix = ""
-            for name, val in zip(parameter_name_list, parameter_vals):
-                if val != "":
-                    # parameter is being used
-                    postfix += f".{name}_{val}"
-            # escape postfix
-            postfix = postfix.replace("/", "_")
-            output_format = CODEC_INFO[codec]["output_format"]
-            outfile = os.path.join(
-                options.tmp_dir,
-                os.path.basename(infile) + postfix + output_format,
+        for input_format in input_format_set:
+            infile = convert_input_file(
+                orig_infile, input_format, options.tmp_dir, options.debug
             )
-            cmd = CODEC_INFO[codec]["encode_command"].format(
-                **parameter_dict, infile=infile, outfile=outfile
+            # keep the basename and size along so workers do not recompute them
+            converted[(orig_infile, input_format)] = (
+                infile,
+                os.path.basename(infile),
+                os.path.getsize(infile),
             )
-            # 3.1. run the encode command
-            # TODO(chema): implement nruns
-            retcode, stdout, stderr, perf_stats = utils.run(
-                cmd, debug=options.debug, get_perf_stats=True
-            )
-            if (
-                retcode != 0
-                and b"Svt[error]" in stderr
-                and b"8k+ resolution support is limited to M8" in stderr
-            ):
-                # TODO(chema): fix this
-                # svt has issues with 8k+ resolution support based on the preset
-                continue
-            assert (
-                retcode == 0
-            ), f"error encoding video file\ncmd: {cmd}\nstdout: {stdout}\nstderr: {stderr}"
-            resolution = utils.get_resolution(infile)
-            # outresolution = utils.get_resolution(outfile)
-            # assert resolution == outresolution, f"error: resolution change\n  {infile}: {resolution}\n  {outfile}: {outresolution}"
-            infilesize = os.path.getsize(infile)
-            outfilesize = os.path.getsize(outfile)
-            numpixels = functools.reduce(
-                int.__mul__, [int(val) for val in resolution.split("x")]
+
+    # 4. run each experiment, dumping results as they complete
+    job_list = [
+        (orig_infile, parameter_vals)
+        for orig_infile in infile_list
+        for parameter_vals in parameter_val_list
+    ]
+    # perf_stats column names are appended once the first result is in
+    header = (
+        ["codec", "infile", "resolution"]
+        + parameter_name_list[1:]
+        + [
+            "infilesize",
+            "inbpp",
+            "outfilesize",
+            "outbpp",
+            "ratiobpp",
+            "psnr",
+            "ssim",
+            "vmaf",
+        ]
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        future_list = [
+            executor.submit(
+                run_single_experiment,
+                orig_infile,
+                *converted[
+                    (orig_infile, CODEC_INFO[parameter_vals[0]]["input_format"])
+                ],
+                *resolution_cache[orig_infile],
+                parameter_vals,
+                parameter_name_list,
+                options,
             )
-            inbpp = (8 * infilesize) / numpixels
-            outbpp = (8 * outfilesize) / numpixels
-            ratiobpp = outbpp / inbpp
-            # 3.2. decode the file (if needed)
-            decode_command = CODEC_INFO[codec].get("decode_command", None)
-            if decode_command is None:
-                distorted_infile = outfile
-            else:
-                distorted_infile = outfile + input_format
-                cmd = decode_command.format(infile=outfile, outfile=distorted_infile)
-                retcode, stdout, stderr, _ = utils.run(cmd, debug=options.debug)
-                assert (
-                    retcode == 0
-                ), f"error decoding video file\ncmd: {cmd}\nstdout: {stdout}\nstderr: {stderr}"
-            # 3.3. calculate the quality score(s)
-            psnr = utils.get_psnr(distorted_infile, infile, None, options.debug)
-            ssim = utils.get_ssim(distorted_infile, infile, None, options.debug)
-            vmaf = utils.get_vmaf(distorted_infile, infile, None, options.debug)
-            # 3.4. store results
-            local_results = (
-                [codec, os.path.basename(infile), resolution]
-                + parameter_vals[1:]
-                + [
-                    infilesize,
-                    inbpp,
-                    outfilesize,
-                    outbpp,
-                    ratiobpp,
-                    psnr,
-                    ssim,
-                    vmaf,
-                ]
-                + list(perf_stats.values())
+            for orig_infile, parameter_vals in job_list
+        ]
+        # do not run the remaining jobs after a failed one
+        for future in future_list:
+            future.add_done_callback(
+                functools.partial(utils.cancel_on_error, future_list=future_list)
             )
-            results.append(local_results)
-    # 4. dump results
-    with open(options.outfile, "w+") as fout:
-        # run the list of encodings
-        header = (
-            "codec,infile,resolution,"
-            + ",".join(parameter_name_list[1:])
-            + ",infilesize,inbpp,outfilesize,outbpp,ratiobpp,psnr,ssim,vmaf,"
-            + ",".join(perf_stats.keys())
-            + "\n"
-        )
-        fout.write(header)
-        for local_results in results:
-            fout.write(",".join(str(item) for item in local_results) + "\n")
+        # write the rows in the original order (one at a time)
+        try:
+            with open(options.outfile, "w", newline="", buffering=1) as fout:
+                writer = csv.writer(fout)
+                for future in future_list:
+                    local_results, perf_stats = future.result()
+                    if local_results is None:
+                        continue
+                    if header is not None:
+                        writer.writerow(header + list(perf_stats.keys()))
+                        header = None
+                    writer.writerow(local_results)
+                if header is not None:
+                    # no results
+                    writer.writerow(header)
+        except BaseException:
+            # a failure aborts the run: drop the queued jobs
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
 
 def get_options(argv):
@@ -318,6 +467,15 @@ def get_options(argv):
         help="Do Not Cleanup Files%s"
         % (" [default]" if not default_values["cleanup"] else ""),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=default_values["jobs"],
+        help="number of experiments to run in parallel",
+    )
     parser.add_argument(
         "--tmp-dir",
         action="store",
@@ -402,9 +560,10 @@ def get_options(argv):
         "heic_preset",
         "avif_speed",
     ):
-        for sep in (",", " "):
-            if len(vars(options)[field]) == 1 and sep in vars(options)[field][0]:
-                vars(options)[field] = vars(options)[field][0].split(sep)
+        if len(vars(options)[field]) == 1:
+            vars(options)[field] = [
+                val for val in LIST_SEPARATOR.split(vars(options)[field][0]) if val
+            ]
     # check valid values in options.codecs
     if not all(c in CODEC_INFO.keys() for c in options.codecs):
         print(
@@ -2,20 +2,27 @@
 # (c) Facebook, Inc. and its affiliates. Confidential and proprietary.
 
 import argparse
-import math
+import concurrent.futures
+import hashlib
+import os
 import sys
 
+import matplotlib
+
+# use a non-interactive backend (figures are only written to disk)
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import seaborn as sb
 
+# resolutions are plotted by height (216x120, 432x240, 640x360, ...)
 RESOLUTIONS = [
-    "216x120",
-    "432x240",
-    "640x360",
-    "864x480",
-    "1280x720",
+    120,
+    240,
+    360,
+    480,
+    720,
 ]
 
 PLOT_NAMES = {
@@ -27,6 +34,8 @@ PLOT_NAMES = {
     "actual_bitrate": "Actual Bitrate",
     "encoder_duration": "Encoder Duration (sec)",
 }
+# y-axes used in the resolution-vmaf plots (quality is the facet column)
+RESOLUTION_VMAF_YCOLS = tuple(ycol for ycol in PLOT_NAMES if ycol != "quality")
 
 COLORS = {
     "mjpeg": "green",
@@ -97,6 +106,13 @@ COLORS2 = {
     },
 }
 
+# flat (codec, resolution) -> color lookup table
+COLOR_TABLE = {
+    (codec, resolution): color
+    for codec, colors in COLORS2.items()
+    for resolution, color in colors.items()
+}
+
 PLOT_TYPES = {
     "bitrate-vmaf",  # traditional rd-test
     "bitrate-ssim",  # traditional rd-test
@@ -109,37 +125,48 @@ PLOT_TYPES = {
     "all",
 }
 
+# explicit dtypes for the rdtest CSV columns (others are inferred). Note
+# that quality is inferred, as it is empty in cbr rows
+CSV_DTYPES = {
+    "infile": str,
+    "codec": str,
+    "resolution": str,
+    "rcmode": str,
+    "preset": str,
+    "actual_bitrate": np.float32,
+    "encoder_duration": np.float32,
+    "psnr_y_mean": np.float32,
+    "ssim_y_mean": np.float32,
+    "vmaf_mean": np.float32,
+}
+
+# parsed input files cache dir (see --cache)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "rdplot"
+)
+
 default_values = {
     "debug": 0,
     "plot_type": "resolution-vmaf",
     "simple": False,
     "filter": False,
+    "cache": False,
     "infiles": [],
     "outfile": None,
 }
 
 
-def get_resolution(row):
-    return int(row["resolution"].split("x")[1])
-
-
-def get_overshoot(row):
-    # bitrate column is quality columns. Of course this only makes sense if it actually is bitrate
-    # but we calculate it just the same. The magnitude for bitrate is in kbps
-    return (100.0 * (row["actual_bitrate"] - row["quality"] * 1000)) / (
-        row["quality"] * 1000
-    )
-
-
 def plot_max_min(df, ycol, ax):
     bitrate = int(ax.title.get_text().split(" = ")[1])
     myset = df[df.bitrate == bitrate]
     max_values = {}
-    for codec in myset.codec.unique():
-        m = myset[myset.codec == codec]
+    # group once instead of re-masking per codec
+    for codec, m in myset.groupby("codec", sort=False, observed=True):
+        # locate the best score once, by position
+        idx = int(np.nanargmax(m[ycol].to_numpy()))
         max_values[codec] = {
-            "resolution": m.loc[m[ycol].idxmax()]["resolution"],
-            ycol: m.loc[m[ycol].idxmax()][ycol],
+            "resolution": m["resolution"].iat[idx],
+            ycol: m[ycol].iat[idx],
         }
     for codec in max_values.keys():
         # add dots and lines for the best scores
@@ -159,27 +186,66 @@ def plot_max_min(df, ycol, ax):
     # ax.vlines(x, y1, y2, color=color)
 
 
+def get_cache_file(infile):
+    # cache files are pickles (loading one runs arbitrary code), so keep
+    # them in a user-owned dir, never next to the (maybe shared) CSV file
+    infile_hash = hashlib.sha1(os.path.realpath(infile).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{infile_hash}.pkl")
+
+
+def read_csv_file(infile, cache):
+    if not cache or not isinstance(infile, str):
+        return pd.read_csv(infile, dtype=CSV_DTYPES)
+    # reuse the parsed file if the cache is newer than the CSV file
+    cache_file = get_cache_file(infile)
+    infile_mtime = os.path.getmtime(infile)
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= infile_mtime:
+        return pd.read_pickle(cache_file)
+    df = pd.read_csv(infile, dtype=CSV_DTYPES)
+    # caching is best-effort (e.g. read-only home dir)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        df.to_pickle(cache_file)
+    except OSError as e:
+        print(f"warning: cannot cache {infile} in {cache_file}: {e}")
+    return df
+
+
 def process_input(options):
-    # create pandas dataframe
-    df = pd.DataFrame([], dtype=None)
     # read CSV input
+    df_list = []
     for infile in options.infiles:
-        df_ = pd.read_csv(infile)
+        df_ = read_csv_file(infile, options.cache)
         df_["in_filename"] = infile
-        if df is None:
-            df = df_
-        else:
-            df = pd.concat([df, df_])
-
-    # add resolution and overshoot fields
-    df["resolution"] = df.apply(lambda row: get_resolution(row), axis=1)
-    df["overshoot"] = df.apply(lambda row: get_overshoot(row), axis=1)
+        df_list.append(df_)
+    # create pandas dataframe (concatenate once)
+    df = pd.concat(df_list, ignore_index=True)
+
+    # add resolution (height) and overshoot fields
+    if "height" in df.columns:
+        # rdtest already writes the height as an integer column
+        df["resolution"] = pd.to_numeric(df["height"], downcast="integer")
+    else:
+        df["resolution"] = pd.to_numeric(
+            df["resolution"].str.rsplit("x", n=1).str[-1], downcast="integer"
+        )
+    # bitrate column is quality columns. Of course this only makes sense if it actually is bitrate
+    # but we calculate it just the same. The magnitude for bitrate is in kbps
+    bitrate = df["quality"] * 1000
+    df["overshoot"] = (100.0 * (df["actual_bitrate"] - bitrate)) / bitrate
     df.sort_values(by=["in_filename", "codec", "resolution", "rcmode"], inplace=True)
+    # downcast numeric columns to shrink memory (and speed up masks/groupby)
+    for col in df.select_dtypes(include="float").columns:
+        df[col] = pd.to_numeric(df[col], downcast="float")
+    for col in df.select_dtypes(include="integer").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    # use categoricals for the low-cardinality string columns, keeping the
+    # (sorted) order of appearance as the category order
+    for col in ("in_filename", "codec", "rcmode"):
+        df[col] = pd.Categorical(df[col], categories=df[col].unique())
     if options.filter:
         # filter overshooting values
-        for index, row in df.iterrows():
-            if row["overshoot"] > 10.0:
-                df.drop(index, inplace=True)
+        df = df.loc[~(df["overshoot"] > 10.0)].reset_index(drop=True)
 
     if options.plot_type == "resolution-vmaf":
         plot_resolution_vmaf(options, df)
@@ -263,39 +329,51 @@ def process_input(options):
 
 
 def plot_resolution_vmaf(options, df):
-    # common plot settings
-    sb.set_style("darkgrid", {"axes.facecolor": ".9"})
-
     xcol = "resolution"
-    for ycol in PLOT_NAMES:
-        if ycol == "quality":
-            continue
-        plot_name = PLOT_NAMES[ycol]
-        kwargs = {
-            "x": xcol,
-            "y": ycol,
-            "col": "quality",
-            "hue": "codec",
-            "ci": "sd",
-            "capsize": 0.2,
-            "palette": "Paired",
-            "height": 6,
-            "aspect": 0.75,
-            "kind": "point",
-            "data": df,
-            "col_wrap": 3,
-            "row_order": RESOLUTIONS,
-        }
-        fg = sb.catplot(**kwargs)
-        fg.set_ylabels(plot_name, fontsize=15)
-        # process all the Axes in the figure
-        for ax in fg.axes:
-            # make sure all the x-axes show xticks
-            plt.setp(ax.get_xticklabels(), visible=True)
-            # plot_max_min(df, ycol, ax)
-        # write to disk
-        outfile = "%s.%s-%s.png" % (options.outfile, xcol, ycol)
-        fg.savefig(outfile)
+    # catplot arguments shared by all the plots (only "y" changes)
+    base_kwargs = {
+        "x": xcol,
+        "col": "quality",
+        "hue": "codec",
+        "ci": "sd",
+        "capsize": 0.2,
+        "palette": "Paired",
+        "height": 6,
+        "aspect": 0.75,
+        "kind": "point",
+        "data": df,
+        "col_wrap": 3,
+        "row_order": RESOLUTIONS,
+    }
+    # plots are independent, so render them in parallel (in separate
+    # processes, as pyplot global state is not thread-safe)
+    max_workers = min(len(RESOLUTION_VMAF_YCOLS), os.cpu_count())
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(plot_resolution_single, options, base_kwargs, ycol)
+            for ycol in RESOLUTION_VMAF_YCOLS
+        ]
+        for future in futures:
+            # re-raise any exception from the workers
+            future.result()
+
+
+def plot_resolution_single(options, base_kwargs, ycol):
+    # common plot settings (set in the worker process)
+    sb.set_style("darkgrid", {"axes.facecolor": ".9"})
+    xcol = base_kwargs["x"]
+    plot_name = PLOT_NAMES[ycol]
+    fg = sb.catplot(**base_kwargs, y=ycol)
+    fg.set_ylabels(plot_name, fontsize=15)
+    # process all the Axes in the figure
+    for ax in fg.axes:
+        # make sure all the x-axes show xticks
+        plt.setp(ax.get_xticklabels(), visible=True)
+        # plot_max_min(df, ycol, ax)
+    # write to disk
+    outfile = "%s.%s-%s.png" % (options.outfile, xcol, ycol)
+    fg.savefig(outfile)
+    plt.close(fg.fig)
 
 
 def plot_traditional(xcol, ycol, options, df, simple=False, **kwargs):
@@ -309,62 +387,65 @@ def plot_traditional(xcol, ycol, options, df, simple=False, **kwargs):
 
 def plot_generic(options, df, xcol, ycol, vcol, pcol, **kwargs):
     # plot the results
-    fig = plt.figure()
     num_pcol = df[pcol].nunique()
     max_ncols = 2
-    ncols = min(num_pcol, max_ncols)
-    nrows = math.ceil(num_pcol / max_ncols)
-    # different plots
-    for plot_id in range(num_pcol):
-        pval = df[pcol].unique()[plot_id]
-        pdf = df[df[pcol] == pval]
-        ax = fig.add_subplot(nrows, ncols, 1 + plot_id)
-        # different lines in each plot
-        for var_id in range(pdf[vcol].nunique()):
-            vval = pdf[vcol].unique()[var_id]
-            color = COLORS[vval]
-            xvals = pdf[pdf[vcol] == vval][xcol].tolist()
-            yvals = pdf[pdf[vcol] == vval][ycol].tolist()
-            label = str(vval)
-            fmt = ".-"
-            ax.plot(xvals, yvals, fmt, label=label, color=color)
-            ax.set_xlabel(PLOT_NAMES[xcol])
-            if plot_id % max_ncols == 0:
-                ax.set_ylabel(PLOT_NAMES[ycol])
-            ax.legend(loc=kwargs.get("legend_loc", "upper left"))
-            ax.set_title("%s: %s" % (pcol, pval))
+    ncols = max(1, min(num_pcol, max_ncols))
+    nrows = max(1, -(-num_pcol // max_ncols))
+    # create the full grid of plots at once
+    fig, axes = plt.subplots(nrows, ncols, squeeze=False)
+    flat_axes = axes.flat
+    # remove the unused cells in the last row
+    for ax in flat_axes[num_pcol:]:
+        ax.remove()
+    # group the data once: one plot per pval, one line per (pval, vval)
+    plot_ids = {}
+    for (pval, vval), vdf in df.groupby([pcol, vcol], observed=True):
+        plot_id = plot_ids.setdefault(pval, len(plot_ids))
+        ax = flat_axes[plot_id]
+        color = COLORS[vval]
+        xvals = vdf[xcol].to_numpy()
+        yvals = vdf[ycol].to_numpy()
+        label = str(vval)
+        fmt = ".-"
+        ax.plot(xvals, yvals, fmt, label=label, color=color)
+    # set the per-plot labels once all the lines are in
+    for pval, plot_id in plot_ids.items():
+        ax = flat_axes[plot_id]
+        ax.set_xlabel(PLOT_NAMES[xcol])
+        if plot_id % max_ncols == 0:
+            ax.set_ylabel(PLOT_NAMES[ycol])
+        ax.legend(loc=kwargs.get("legend_loc", "upper left"))
+        ax.set_title("%s: %s" % (pcol, pval))
     # write to disk
     outfile = "%s.%s-%s.png" % (options.outfile, xcol, ycol)
-    plt.savefig(outfile)
+    fig.savefig(outfile)
+    # release the figure (the "all" plot type creates several of them)
+    plt.close(fig)
 
 
 # same than plot_generic, but mixing pcol and vcol in the same Figure
 def plot_generic_simple(options, df, xcol, ycol, vcol, pcol, **kwargs):
     # plot the results
     fig = plt.figure()
-    num_pcol = df[pcol].nunique()
     # different plots
     ax = fig.add_subplot(1, 1, 1)
-    # turn plots into lines
-    for plot_id in range(num_pcol):
-        pval = df[pcol].unique()[plot_id]
-        pdf = df[df[pcol] == pval]
+    # turn plots into lines (grouping the data once)
+    for (pval, vval), vdf in df.groupby([pcol, vcol], observed=True):
         fmt = FORMATS[pval]
-        # different lines in each plot
-        for var_id in range(pdf[vcol].nunique()):
-            vval = pdf[vcol].unique()[var_id]
-            color = COLORS2[vval][pval]
-            xvals = pdf[pdf[vcol] == vval][xcol].tolist()
-            yvals = pdf[pdf[vcol] == vval][ycol].tolist()
-            label = "%s.%s" % (str(pval), str(vval))
-            ax.plot(xvals, yvals, fmt, label=label, color=color)
-            ax.set_xlabel(PLOT_NAMES[xcol])
-            ax.set_ylabel(PLOT_NAMES[ycol])
-            ax.legend(loc=kwargs.get("legend_loc", "lower right"))
-    ax.set_title("%s" % (list(df.iterrows())[0][1]["in_filename"]))
+        color = COLOR_TABLE[(vval, pval)]
+        xvals = vdf[xcol].to_numpy()
+        yvals = vdf[ycol].to_numpy()
+        label = "%s.%s" % (str(pval), str(vval))
+        ax.plot(xvals, yvals, fmt, label=label, color=color)
+    ax.set_xlabel(PLOT_NAMES[xcol])
+    ax.set_ylabel(PLOT_NAMES[ycol])
+    ax.legend(loc=kwargs.get("legend_loc", "lower right"))
+    ax.set_title("%s" % df["in_filename"].iat[0])
     # write to disk
     outfile = "%s.%s-%s.png" % (options.outfile, xcol, ycol)
-    plt.savefig(outfile)
+    fig.savefig(outfile)
+    # release the figure (the "all" plot type creates several of them)
+    plt.close(fig)
 
 
 def get_options(argv):
@@ -411,6 +492,13 @@ def get_options(argv):
         default=default_values["filter"],
         help="Filter Out Overshooting Samples",
     )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        dest="cache",
+        default=default_values["cache"],
+        help=f"Cache Parsed Input Files (as pickle files in {CACHE_DIR})",
+    )
     parser.add_argument(
         "--plot",
         action="store",
@@ -6,11 +6,20 @@
 # pylint: disable-msg=C0103
 
 import argparse
+import concurrent.futures
+import functools
+import hashlib
 import itertools
+import json
+import multiprocessing
 import os
 import pandas as pd
 import pathlib
+import shlex
+import sqlite3
+import stat
 import sys
+import tempfile
 
 import utils
 
@@ -20,11 +29,14 @@ CODEC_INFO = {
         "codecname": "mjpeg",
         "extension": ".mp4",
         "parameters": {},
+        # supported rcmodes (default: all)
+        "rcmodes": ("crf",),
     },
     "x264": {
         "codecname": "libx264",
         "extension": ".mp4",
         "parameters": {},
+        "threading-parameters": ["-threads", "{threads}"],
         "preset-name": "preset",
         "presets": (
             "ultrafast",
@@ -43,6 +55,7 @@ CODEC_INFO = {
         "codecname": "libopenh264",
         "extension": ".mp4",
         "parameters": {},
+        "threading-parameters": ["-threads", "{threads}"],
         "preset-name": "complexity",
         "presets": ("0", "1", "2"),
     },
@@ -50,6 +63,7 @@ CODEC_INFO = {
         "codecname": "libx265",
         "extension": ".mp4",
         "parameters": {},
+        "threading-parameters": ["-x265-params", "pools={threads}"],
         "preset-name": "preset",
         "presets": (
             "ultrafast",
@@ -71,6 +85,7 @@ CODEC_INFO = {
             # quality parameters
             "quality": "realtime",
         },
+        "threading-parameters": ["-threads", "{threads}"],
         "preset-name": "cpu-used",
         "presets": (
             "0",
@@ -101,6 +116,7 @@ CODEC_INFO = {
             "qmin": 2,
             "qmax": 56,
         },
+        "threading-parameters": ["-row-mt", "1", "-threads", "{threads}"],
         "preset-name": "cpu-used",
         "presets": ("0", "1", "2", "3", "4", "5", "6", "7", "8", "9"),
     },
@@ -112,6 +128,7 @@ CODEC_INFO = {
             # this should reduce the encoding time to manageable levels
             # "cpu-used": 5,
         },
+        "threading-parameters": ["-row-mt", "1", "-threads", "{threads}"],
         "preset-name": "cpu-used",
         "presets": ("0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11"),
     },
@@ -119,6 +136,7 @@ CODEC_INFO = {
         "codecname": "libsvtav1",
         "extension": ".mp4",
         "parameters": {},
+        "threading-parameters": ["-svtav1-params", "lp={threads}"],
         "preset-name": "preset",
         "presets": (
             "-1",
@@ -143,6 +161,7 @@ CODEC_INFO = {
         "extension": ".ivf",
         "binary": "SvtAv1EncApp",
         "parameters": {},
+        "threading-parameters": ["--lp", "{threads}"],
         "preset-name": "preset",
         "presets": (
             "-1",
@@ -162,11 +181,124 @@ CODEC_INFO = {
             "13",
         ),
     },
+    "h264_nvenc": {
+        "codecname": "h264_nvenc",
+        "extension": ".mp4",
+        "parameters": {},
+        # hardware encoder: only used when explicitly requested
+        "hardware": True,
+        "quality-name": "cq",
+        "preset-name": "preset",
+        "presets": ("p1", "p2", "p3", "p4", "p5", "p6", "p7"),
+    },
+    "hevc_nvenc": {
+        "codecname": "hevc_nvenc",
+        "extension": ".mp4",
+        "parameters": {},
+        # hardware encoder: only used when explicitly requested
+        "hardware": True,
+        "quality-name": "cq",
+        "preset-name": "preset",
+        "presets": ("p1", "p2", "p3", "p4", "p5", "p6", "p7"),
+    },
+    "av1_nvenc": {
+        "codecname": "av1_nvenc",
+        "extension": ".mp4",
+        "parameters": {},
+        # hardware encoder: only used when explicitly requested
+        "hardware": True,
+        "quality-name": "cq",
+        "preset-name": "preset",
+        "presets": ("p1", "p2", "p3", "p4", "p5", "p6", "p7"),
+    },
+    "h264_qsv": {
+        "codecname": "h264_qsv",
+        "extension": ".mp4",
+        "parameters": {},
+        # hardware encoder: only used when explicitly requested
+        "hardware": True,
+        "quality-name": "global_quality",
+        "preset-name": "preset",
+        "presets": (
+            "veryfast",
+            "faster",
+            "fast",
+            "medium",
+            "slow",
+            "slower",
+            "veryslow",
+        ),
+    },
+    "hevc_qsv": {
+        "codecname": "hevc_qsv",
+        "extension": ".mp4",
+        "parameters": {},
+        # hardware encoder: only used when explicitly requested
+        "hardware": True,
+        "quality-name": "global_quality",
+        "preset-name": "preset",
+        "presets": (
+            "veryfast",
+            "faster",
+            "fast",
+            "medium",
+            "slow",
+            "slower",
+            "veryslow",
+        ),
+    },
+}
+
+
+# per-codec parameter strings, derived once from CODEC_INFO
+# (csv column value and encoder command-line arguments)
+CODEC_PARAMETERS_CSV = {
+    codec: "".join(f"{k}={v};" for k, v in info["parameters"].items())
+    for codec, info in CODEC_INFO.items()
+}
+CODEC_PARAMETERS_ARGV = {
+    codec: [arg for k, v in info["parameters"].items() for arg in (f"-{k}", str(v))]
+    for codec, info in CODEC_INFO.items()
+}
+# per-codec ffmpeg preset and constant-quality options (hardware
+# encoders use their own constant-quality option)
+CODEC_PRESET_ARG = {
+    codec: f"-{info['preset-name']}"
+    for codec, info in CODEC_INFO.items()
+    if "preset-name" in info
+}
+# encoders run without b-frames (so all the RD points share the same GOP
+# structure)
+NO_BFRAMES_CODECNAMES = frozenset(
+    (
+        "libx264",
+        "libx265",
+        "h264_nvenc",
+        "hevc_nvenc",
+        "av1_nvenc",
+        "h264_qsv",
+        "hevc_qsv",
+    )
+)
+CODEC_QUALITY_ARG = {
+    codec: f"-{info.get('quality-name', 'crf')}" for codec, info in CODEC_INFO.items()
 }
 
 
-# codecs
-DEFAULT_CODECS = CODEC_INFO.keys()
+def get_threading_argv(codec, encoder_threads):
+    # per-codec encoder threading options (none if encoder_threads is None)
+    if encoder_threads is None:
+        return []
+    return [
+        arg.format(threads=encoder_threads)
+        for arg in CODEC_INFO[codec].get("threading-parameters", ())
+    ]
+
+
+# codecs (hardware encoders must be requested explicitly)
+DEFAULT_CODECS = [
+    codec for codec, info in CODEC_INFO.items() if not info.get("hardware")
+]
 
 
 # resolution set 1
@@ -240,15 +372,33 @@ DEFAULT_RCMODES = [
     "crf",
 ]
 
+OUTPUT_FORMATS = ("csv", "sqlite")
+# results table name for the sqlite output format
+SQLITE_TABLE = "results"
+
+# default parent of the per-run tmp dir (a tmpfs in most linux systems)
+SHM_DIR = "/dev/shm"
+
+VALID_CODECS = frozenset(CODEC_INFO)
+VALID_RCMODES = frozenset(DEFAULT_RCMODES)
+
 
 default_values = {
     "debug": 0,
     "cleanup": 0,
+    "jobs": 1,
+    "pin_jobs": False,
     "label": "",
     "ref_res": None,
     "ref_pix_fmt": "yuv420p",
     "vmaf_dir": "/tmp/",
-    "tmp_dir": "/tmp/",
+    "libvmaf_features": False,
+    "vmaf_cuda": False,
+    "reuse_encodes": False,
+    "force_ref": False,
+    "output_format": "csv",
+    "print_commands": False,
+    "tmp_dir": None,
     "gop_length_frames": 600,
     "codecs": DEFAULT_CODECS,
     "resolutions": DEFAULT_RESOLUTIONS,
@@ -261,34 +411,154 @@ default_values = {
 }
 
 
+def get_usable_cores():
+    # cores this process may run on (this honors cpusets and container
+    # limits, unlike os.cpu_count())
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_core_partitions(jobs):
+    # split the usable cores in "jobs" disjoint sets of the same size
+    # (None if there are not enough cores, or no affinity support)
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+    cores = get_usable_cores()
+    if len(cores) < jobs:
+        return None
+    cores_per_job = len(cores) // jobs
+    return [cores[i * cores_per_job : (i + 1) * cores_per_job] for i in range(jobs)]
+
+
+def pin_worker(core_queue):
+    # pin a pool worker to its own set of cores (the encoder and ffmpeg
+    # processes it launches inherit the affinity)
+    os.sched_setaffinity(0, core_queue.get())
+
+
+def check_private_dir(path):
+    # the default tmp dir has a predictable name in a shared dir: make sure
+    # it is a real dir only writable by us, so that other local users cannot
+    # plant ref files or symlinks that we would reuse or write through
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    error = None
+    if stat.S_ISLNK(st.st_mode) or not stat.S_ISDIR(st.st_mode):
+        error = "is a symlink or not a dir"
+    elif st.st_uid != os.getuid():
+        error = "is not owned by the current user"
+    elif st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        error = "is group/other-writable"
+    if error is not None:
+        print(f"# error: tmp dir {path} {error}: use --tmp-dir")
+        sys.exit(-1)
+
+
 def run_experiment(options):
     # check all software is ok
-    utils.check_software(options.debug)
+    utils.check_software(options.debug, options.vmaf_cuda)
 
-    # prepare output directory
+    # prepare output directory (default to a stable per-user dir, in shared
+    # memory if available, so that later runs overwrite or reuse its files
+    # instead of piling up new dirs)
+    if options.tmp_dir is None:
+        tmp_parent = SHM_DIR if os.path.ismount(SHM_DIR) else tempfile.gettempdir()
+        options.tmp_dir = os.path.join(tmp_parent, f"rdtest.{os.getuid()}")
+        check_private_dir(options.tmp_dir)
     pathlib.Path(options.tmp_dir).mkdir(parents=True, exist_ok=True)
-
-    df = None
-    for infile in options.infile_list:
-        df_tmp = run_experiment_single_file(
-            infile,
-            options.label,
-            options.codecs,
-            options.resolutions,
-            options.rcmodes,
-            options.presets,
-            options.bitrates,
-            options.qualities,
-            options.ref_res,
-            options.ref_pix_fmt,
-            options.gop_length_frames,
-            options.tmp_dir,
-            options.cleanup,
-            options.debug,
+    if options.debug > 0:
+        print(f"# [run] using tmp dir: {options.tmp_dir}")
+    if utils.is_tmpfs(options.tmp_dir) is False:
+        print(
+            f"warn: tmp dir {options.tmp_dir} is not in a tmpfs: consider "
+            "using --tmp-dir /dev/shm/... to avoid disk I/O"
         )
-        df = df_tmp if df is None else pd.concat([df, df_tmp])
-    # write up the results
-    df.to_csv(options.outfile, index=False)
+
+    # process the input files concurrently: all the experiments share a
+    # single process pool (so at most "jobs" experiments run at the same
+    # time), while a thread per file prepares its ref file, submits its
+    # experiments, and collects its results
+    num_files = max(1, min(len(options.infile_list), options.jobs))
+    # optionally pin each pool worker to a disjoint set of cores
+    pool_kwargs = {}
+    if options.pin_jobs:
+        core_partitions = get_core_partitions(options.jobs)
+        if core_partitions is None:
+            print(f"warn: cannot pin {options.jobs} job(s) to the available cores")
+        else:
+            core_queue = multiprocessing.SimpleQueue()
+            for cores in core_partitions:
+                core_queue.put(cores)
+            pool_kwargs = {"initializer": pin_worker, "initargs": (core_queue,)}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=options.jobs, **pool_kwargs
+    ) as executor, concurrent.futures.ThreadPoolExecutor(
+        max_workers=num_files
+    ) as file_executor:
+        future_list = [
+            file_executor.submit(
+                run_experiment_single_file,
+                infile,
+                options.label,
+                options.codecs,
+                options.resolutions,
+                options.rcmodes,
+                options.presets,
+                options.bitrates,
+                options.qualities,
+                options.ref_res,
+                options.ref_pix_fmt,
+                options.gop_length_frames,
+                options.tmp_dir,
+                options.cleanup,
+                options.libvmaf_features,
+                options.vmaf_cuda,
+                options.reuse_encodes,
+                options.force_ref,
+                options.jobs,
+                options.pin_jobs,
+                executor,
+                options.print_commands,
+                options.debug,
+            )
+            for infile in options.infile_list
+        ]
+        # do not start the remaining files after a failed one
+        for future in future_list:
+            future.add_done_callback(
+                functools.partial(utils.cancel_on_error, future_list=future_list)
+            )
+        # write up the results as each file is done (in the original
+        # order), so partial results survive a crash
+        try:
+            for i, future in enumerate(future_list):
+                df_tmp = future.result()
+                if options.print_commands:
+                    continue
+                write_results(df_tmp, options.outfile, options.output_format, i > 0)
+        except BaseException:
+            # a failure aborts the run: drop the queued experiments and files
+            executor.shutdown(wait=False, cancel_futures=True)
+            file_executor.shutdown(cancel_futures=True)
+            raise
+
+
+def write_results(df, outfile, output_format, append):
+    if output_format == "csv":
+        df.to_csv(outfile, mode="a" if append else "w", header=not append, index=False)
+    elif output_format == "sqlite":
+        # one transaction per call
+        conn = sqlite3.connect(outfile)
+        try:
+            df.to_sql(
+                SQLITE_TABLE,
+                conn,
+                if_exists="append" if append else "replace",
+                index=False,
+            )
+        finally:
+            conn.close()
 
 
 def run_experiment_single_file(
@@ -305,15 +575,27 @@ def run_experiment_single_file(
     gop_length_frames,
     tmp_dir,
     cleanup,
+    libvmaf_features,
+    vmaf_cuda,
+    reuse_encodes,
+    force_ref,
+    jobs,
+    pin_jobs,
+    executor,
+    print_commands,
     debug,
 ):
     # 1. in: get infile information
     if debug > 0:
-        print("# [run] parsing file: %s" % (infile))
-    assert os.access(infile, os.R_OK), "file %s is not readable" % infile
+        print(f"# [run] parsing file: {infile}")
+    assert os.access(infile, os.R_OK), f"file {infile} is not readable"
     in_basename = os.path.basename(infile)
     in_resolution = utils.get_resolution(infile)
-    in_framerate = utils.get_framerate(infile)
+    # use a tmp subdir per input file (named after its full path), so that
+    # input files with the same basename never share ref or encoded files
+    infile_hash = hashlib.sha1(os.path.realpath(infile).encode()).hexdigest()[:8]
+    tmp_dir = os.path.join(tmp_dir, f"{in_basename}.{infile_hash}")
+    pathlib.Path(tmp_dir).mkdir(parents=True, exist_ok=True)
 
     # 2. ref: decode the original file into a raw file
     ref_basename = f"{in_basename}.ref_{in_resolution}.y4m"
@@ -321,35 +603,61 @@ def run_experiment_single_file(
         print(f"# [run] normalize file: {infile} -> {ref_basename}")
     ref_filename = os.path.join(tmp_dir, ref_basename)
     ref_resolution = in_resolution if ref_res is None else ref_res
-    ref_framerate = in_framerate
     ref_pix_fmt = ref_pix_fmt
-    ffmpeg_params = [
-        "-y",
-        "-i",
-        infile,
-        "-s",
-        ref_resolution,
-        "-pix_fmt",
-        ref_pix_fmt,
-        ref_filename,
-    ]
-    retcode, stdout, stderr, _ = utils.ffmpeg_run(ffmpeg_params, debug)
-    assert retcode == 0, stderr
-    # check produced file matches the requirements
-    assert ref_resolution == utils.get_resolution(
-        ref_filename
-    ), "Error: %s must have resolution: %s (is %s)" % (
-        ref_filename,
-        ref_resolution,
-        utils.get_resolution(ref_filename),
-    )
-    assert ref_pix_fmt == utils.get_pix_fmt(
-        ref_filename
-    ), "Error: %s must have pix_fmt: %s (is %s)" % (
-        ref_filename,
-        ref_pix_fmt,
-        utils.get_pix_fmt(ref_filename),
-    )
+    if (
+        os.path.splitext(infile)[1].lower() == ".y4m"
+        and ref_resolution == in_resolution
+        and ref_pix_fmt == utils.get_pix_fmt(infile)
+    ):
+        # the input file is already a valid raw ref: use it directly
+        if debug > 0:
+            print(f"# [run] using {infile} as ref file")
+        ref_filename = infile
+    elif (
+        not force_ref
+        and os.path.exists(ref_filename)
+        and os.path.getmtime(ref_filename) >= os.path.getmtime(infile)
+        and ref_resolution == utils.get_resolution(ref_filename)
+        and ref_pix_fmt == utils.get_pix_fmt(ref_filename)
+    ):
+        # a previous run already produced this ref file
+        if debug > 0:
+            print(f"# [run] reusing ref file: {ref_filename}")
+    else:
+        # write to a temporary name first, so that an interrupted run never
+        # leaves a partial ref file behind
+        tmp_ref_filename = ref_filename + ".tmp"
+        ffmpeg_params = [
+            "-y",
+            "-i",
+            infile,
+            "-s",
+            ref_resolution,
+            "-pix_fmt",
+            ref_pix_fmt,
+            "-f",
+            "yuv4mpegpipe",
+            tmp_ref_filename,
+        ]
+        retcode, stdout, stderr, _ = utils.ffmpeg_run(ffmpeg_params, debug)
+        assert retcode == 0, stderr
+        os.replace(tmp_ref_filename, ref_filename)
+    # check produced file matches the requirements (ffmpeg obeys "-s" and
+    # "-pix_fmt", so only probe the ref file again in debug mode)
+    if debug > 0:
+        actual_resolution = utils.get_resolution(ref_filename)
+        assert (
+            ref_resolution == actual_resolution
+        ), f"Error: {ref_filename} must have resolution: {ref_resolution} (is {actual_resolution})"
+        actual_pix_fmt = utils.get_pix_fmt(ref_filename)
+        assert (
+            ref_pix_fmt == actual_pix_fmt
+        ), f"Error: {ref_filename} must have pix_fmt: {ref_pix_fmt} (is {actual_pix_fmt})"
+    # probe the ref framerate and duration once (not once per experiment):
+    # the encoded files keep the ref number of frames and framerate, so
+    # their duration is the ref one
+    ref_framerate = utils.get_framerate(ref_filename)
+    ref_duration = float(utils.get_duration(ref_filename))
 
     columns_init = (
         "infile",
@@ -366,66 +674,190 @@ def run_experiment_single_file(
         "actual_bitrate",
     )
     columns_fini = ("parameters",)
-    df = None
+    columns = None
+    row_list = []
 
-    # run the list of encodings
-    for codec, resolution, rcmode, preset in itertools.product(
-        codecs, resolutions, rcmodes, presets
-    ):
-        if resolution is None:
-            resolution = in_resolution
-        parameters_csv_str = ""
-        for k, v in CODEC_INFO[codec]["parameters"].items():
-            parameters_csv_str += "%s=%s;" % (k, str(v))
-        # get bitrate/quality list
-        if rcmode == "cbr":
-            quality_bitrate_option = "bitrate"
-            qualities_bitrates = bitrates
-        elif rcmode == "crf":
-            quality_bitrate_option = "quality"
-            qualities_bitrates = qualities
-        for quality_bitrate in qualities_bitrates:
-            (
-                encoder_stats,
-                actual_bitrate,
-                psnr_dict,
-                ssim_dict,
-                vmaf_dict,
-            ) = run_single_experiment(
+    # get the list of encodings
+    # skip the grid points a codec does not support (rcmodes) or that would
+    # produce identical encodings (presets for codecs without presets, and
+    # repeated values)
+    experiment_list = []
+    experiment_set = set()
+    num_unsupported_presets = 0
+    # cbr experiments sweep the bitrates, crf ones the qualities
+    sweep_by_rcmode = {
+        "cbr": ("bitrate", bitrates),
+        "crf": ("quality", qualities),
+    }
+    for codec in codecs:
+        codec_rcmodes = CODEC_INFO[codec].get("rcmodes", rcmodes)
+        codec_rcmodes = [rcmode for rcmode in rcmodes if rcmode in codec_rcmodes]
+        # only run the presets the codec supports (an empty preset means
+        # the encoder default preset)
+        codec_presets = ("",)
+        if "preset-name" in CODEC_INFO[codec]:
+            codec_presets = [p for p in presets if p in CODEC_INFO[codec]["presets"]]
+            unsupported_presets = [p for p in presets if p not in codec_presets]
+            num_unsupported_presets += len(unsupported_presets)
+            if unsupported_presets and debug > 0:
+                print(
+                    f"# [run] {codec}: skipping unsupported presets: "
+                    f"{unsupported_presets}"
+                )
+            if not codec_presets:
+                # none of the requested presets is supported
+                codec_presets = ("",)
+        parameters_csv_str = CODEC_PARAMETERS_CSV[codec]
+        for resolution, rcmode, preset in itertools.product(
+            resolutions, codec_rcmodes, codec_presets
+        ):
+            if resolution is None:
+                resolution = in_resolution
+            quality_bitrate_option, qualities_bitrates = sweep_by_rcmode[rcmode]
+            for quality_bitrate in qualities_bitrates:
+                experiment = (
+                    codec,
+                    resolution,
+                    rcmode,
+                    preset,
+                    parameters_csv_str,
+                    quality_bitrate_option,
+                    quality_bitrate,
+                )
+                if experiment in experiment_set:
+                    continue
+                experiment_set.add(experiment)
+                experiment_list.append(experiment)
+    if debug > 0:
+        num_grid = (
+            len(codecs)
+            * len(resolutions)
+            * len(presets)
+            * sum(len(sweep_by_rcmode[rcmode][1]) for rcmode in rcmodes)
+        )
+        print(
+            f"# [run] experiments: {len(experiment_list)} "
+            f"(skipped {num_grid - len(experiment_list)} grid points, "
+            f"{num_unsupported_presets} unsupported codec presets)"
+        )
+
+    # split the cores among the parallel jobs to avoid oversubscription (a
+    # single unpinned job keeps the encoder and ffmpeg threading defaults)
+    encoder_threads = None
+    if jobs > 1 or pin_jobs:
+        encoder_threads = max(1, len(get_usable_cores()) // jobs)
+
+    if print_commands:
+        # only dump the encoder commands (e.g. for GNU parallel)
+        for (
+            codec,
+            resolution,
+            rcmode,
+            preset,
+            _,
+            quality_bitrate_option,
+            quality_bitrate,
+        ) in experiment_list:
+            enc_filename = get_encoded_filename(
                 ref_filename,
                 ref_resolution,
-                ref_pix_fmt,
-                ref_framerate,
                 codec,
                 resolution,
                 quality_bitrate_option,
                 quality_bitrate,
                 preset,
                 rcmode,
-                gop_length_frames,
                 tmp_dir,
-                debug,
-                cleanup,
             )
-            width, height = resolution.split("x")
-            ref_framerate = utils.get_framerate(ref_filename)
-            if quality_bitrate_option == "bitrate":
-                quality = ""
-                bitrate = quality_bitrate
-            elif quality_bitrate_option == "quality":
-                bitrate = ""
-                quality = quality_bitrate
-            if df is None:
-                columns = (
-                    columns_init
-                    + tuple(encoder_stats.keys())
-                    + tuple(psnr_dict.keys())
-                    + tuple(ssim_dict.keys())
-                    + tuple(vmaf_dict.keys())
-                    + columns_fini
-                )
-                df = pd.DataFrame(columns=columns)
-            df.loc[len(df.index)] = (
+            cmd, _ = get_encoder_command(
+                ref_filename,
+                enc_filename,
+                codec,
+                resolution,
+                quality_bitrate,
+                preset,
+                rcmode,
+                gop_length_frames,
+                encoder_threads,
+            )
+            print(shlex.join(cmd))
+        return None
+
+    # run the list of encodings (the experiments are independent, so they
+    # can run in parallel)
+    future_list = [
+        executor.submit(
+            run_single_experiment,
+            ref_filename,
+            ref_resolution,
+            ref_pix_fmt,
+            ref_framerate,
+            ref_duration,
+            codec,
+            resolution,
+            quality_bitrate_option,
+            quality_bitrate,
+            preset,
+            rcmode,
+            gop_length_frames,
+            encoder_threads,
+            tmp_dir,
+            debug,
+            cleanup,
+            libvmaf_features,
+            vmaf_cuda,
+            reuse_encodes,
+        )
+        for (
+            codec,
+            resolution,
+            rcmode,
+            preset,
+            _,
+            quality_bitrate_option,
+            quality_bitrate,
+        ) in experiment_list
+    ]
+    # do not run the remaining experiments of a failed file
+    for future in future_list:
+        future.add_done_callback(
+            functools.partial(utils.cancel_on_error, future_list=future_list)
+        )
+    # collect the results in the original order
+    for (
+        codec,
+        resolution,
+        rcmode,
+        preset,
+        parameters_csv_str,
+        quality_bitrate_option,
+        quality_bitrate,
+    ), future in zip(experiment_list, future_list):
+        (
+            encoder_stats,
+            actual_bitrate,
+            psnr_dict,
+            ssim_dict,
+            vmaf_dict,
+        ) = future.result()
+        width, height = resolution.split("x")
+        if quality_bitrate_option == "bitrate":
+            quality = ""
+            bitrate = quality_bitrate
+        elif quality_bitrate_option == "quality":
+            bitrate = ""
+            quality = quality_bitrate
+        if columns is None:
+            columns = (
+                columns_init
+                + tuple(encoder_stats.keys())
+                + tuple(psnr_dict.keys())
+                + tuple(ssim_dict.keys())
+                + tuple(vmaf_dict.keys())
+                + columns_fini
+            )
+        row_list.append(
+            (
                 in_basename,
                 label,
                 codec,
@@ -444,9 +876,207 @@ def run_experiment_single_file(
                 *vmaf_dict.values(),
                 parameters_csv_str,
             )
+        )
+    # remove the raw ref file (if we created it)
+    if cleanup > 0 and ref_filename != infile:
+        os.remove(ref_filename)
+    # remove the per-input tmp subdir (if nothing is left in it)
+    if cleanup > 1 and not os.listdir(tmp_dir):
+        os.rmdir(tmp_dir)
+    # create the dataframe once
+    df = pd.DataFrame.from_records(row_list, columns=columns)
     return df
 
 
+def build_svtav1_argv(
+    codec,
+    infile,
+    outfile,
+    rcmode,
+    quality_bitrate,
+    preset,
+    resolution,
+    gop_length_frames,
+    encoder_threads,
+):
+    enc_tool = CODEC_INFO[codec]["binary"]
+    # ~/work/video/av1/svt-av1/Bin/Release/SvtAv1EncApp --rc 1 --lp 1 --tbr 14000 --preset 10 --keyint 600 -i /tmp/rdtest_py_tmp/easy.mp4.ref_1728x2304.y4m --output /tmp/rdtest_py_tmp/foo.mp4.ivf
+    enc_parms = ["-i", infile]
+    if rcmode == "cbr":
+        # TODO(chema): use VBR (1) instead of CBR (2) as SvtAv1EncApp is complaining
+        # Svt[error]: CBR Rate control is currently not supported for SVT_AV1_PRED_RANDOM_ACCESS, use VBR mode
+        # enc_parms += ["--rc", "2"]
+        enc_parms += ["--rc", "1", "--tbr", str(quality_bitrate)]
+    elif rcmode == "crf":
+        enc_parms += ["--rc", "0", "--crf", str(quality_bitrate)]
+    if preset != "":
+        enc_parms += ["--preset", str(preset)]
+    enc_parms += get_threading_argv(codec, encoder_threads)
+    if gop_length_frames is not None:
+        enc_parms += ["--keyint", str(gop_length_frames)]
+    enc_parms += ["--output", outfile]
+    return enc_tool, enc_parms, None
+
+
+def build_mjpeg_argv(
+    codec,
+    infile,
+    outfile,
+    rcmode,
+    quality_bitrate,
+    preset,
+    resolution,
+    gop_length_frames,
+    encoder_threads,
+):
+    # TODO(chema): use bitrate as quality value (2-31)
+    assert rcmode == "crf", f"error: mjpeg only defined for {rcmode}"
+    # the encoder input is always the (y4m) ref file
+    enc_parms = ["-y", *utils.FFMPEG_QUIET_PARAMS]
+    enc_parms += [*utils.FFMPEG_Y4M_INPUT_PARAMS, "-i", infile]
+    enc_parms += ["-c:v", CODEC_INFO[codec]["codecname"]]
+    enc_parms += ["-q:v", str(quality_bitrate)]
+    enc_parms += ["-s", resolution]
+    # pass audio through
+    enc_parms += ["-c:a", "copy", outfile]
+    return "ffmpeg", enc_parms, None
+
+
+def build_ffmpeg_argv(
+    codec,
+    infile,
+    outfile,
+    rcmode,
+    quality_bitrate,
+    preset,
+    resolution,
+    gop_length_frames,
+    encoder_threads,
+):
+    codecname = CODEC_INFO[codec]["codecname"]
+    # the encoder input is always the (y4m) ref file
+    enc_parms = ["-y", *utils.FFMPEG_QUIET_PARAMS]
+    enc_parms += [*utils.FFMPEG_Y4M_INPUT_PARAMS, "-i", infile]
+    enc_parms += ["-c:v", codecname]
+    if rcmode == "cbr":
+        # enc_parms += ["-maxrate", "%sk" % bitrate]
+        # enc_parms += ["-minrate", "%sk" % bitrate]
+        enc_parms += ["-b:v", f"{quality_bitrate}k"]
+        # if CODEC_INFO[codec]["codecname"] in ("libx264", "libopenh264", "libx265"):
+        #    # set bufsize to 2x the bitrate
+        #    bufsize = str(int(bitrate) * 2)
+        #    enc_parms += ["-bufsize", bufsize]
+    elif rcmode == "crf":
+        enc_parms += [CODEC_QUALITY_ARG[codec], str(quality_bitrate)]
+
+    if codecname in NO_BFRAMES_CODECNAMES:
+        # no b-frames
+        enc_parms += ["-bf", "0"]
+    # add preset (if available and not the encoder default)
+    if codec in CODEC_PRESET_ARG and preset != "":
+        enc_parms += [CODEC_PRESET_ARG[codec], preset]
+    enc_parms += ["-s", resolution]
+    if gop_length_frames is not None:
+        enc_parms += ["-g", str(gop_length_frames)]
+    enc_parms += CODEC_PARAMETERS_ARGV[codec]
+    enc_parms += get_threading_argv(codec, encoder_threads)
+    if codecname in ("libaom-av1",):
+        # ABR at https://trac.ffmpeg.org/wiki/Encode/AV1
+        enc_parms += ["-strict", "experimental"]
+    # pass audio through
+    enc_parms += ["-c:a", "copy", outfile]
+    return "ffmpeg", enc_parms, None
+
+
+# per-codecname encoder command builders (default: ffmpeg)
+ENCODER_BUILDERS = {
+    "libsvtav1-raw": build_svtav1_argv,
+    "mjpeg": build_mjpeg_argv,
+}
+
+
+def compile_encoder(codec, rcmode, gop_length_frames, encoder_threads, has_preset):
+    # build the encoder command once, with str.format() placeholders for
+    # the per-experiment values (an empty preset means the encoder default,
+    # so it gets no placeholder)
+    build_argv = ENCODER_BUILDERS.get(CODEC_INFO[codec]["codecname"], build_ffmpeg_argv)
+    enc_tool, enc_parms, enc_env = build_argv(
+        codec,
+        "{infile}",
+        "{outfile}",
+        rcmode,
+        "{quality_bitrate}",
+        "{preset}" if has_preset else "",
+        "{resolution}",
+        gop_length_frames,
+        encoder_threads,
+    )
+    template = [enc_tool] + enc_parms
+    slots = [i for i, arg in enumerate(template) if "{" in arg]
+    return template, slots, enc_env
+
+
+def render_encoder(compiled, values):
+    template, slots, enc_env = compiled
+    cmd = template.copy()
+    for i in slots:
+        cmd[i] = template[i].format(**values)
+    return cmd, enc_env
+
+
+# encoder commands are compiled once per (codec, rcmode, gop_length_frames,
+# encoder_threads, has_preset) tuple (and process)
+COMPILED_ENCODERS = {}
+
+
+def get_encoder_command(
+    infile,
+    outfile,
+    codec,
+    resolution,
+    quality_bitrate,
+    preset,
+    rcmode,
+    gop_length_frames,
+    encoder_threads,
+):
+    key = (codec, rcmode, gop_length_frames, encoder_threads, preset != "")
+    if key not in COMPILED_ENCODERS:
+        COMPILED_ENCODERS[key] = compile_encoder(*key)
+    return render_encoder(
+        COMPILED_ENCODERS[key],
+        {
+            "infile": infile,
+            "outfile": outfile,
+            "quality_bitrate": quality_bitrate,
+            "preset": preset,
+            "resolution": resolution,
+        },
+    )
+
+
+def get_encoded_filename(
+    ref_filename,
+    ref_resolution,
+    codec,
+    resolution,
+    quality_bitrate_option,
+    quality_bitrate,
+    preset,
+    rcmode,
+    tmp_dir,
+):
+    ref_basename = os.path.basename(ref_filename)
+    gen_basename = ref_basename + f".ref_{ref_resolution}"
+    gen_basename += f".codec_{codec}"
+    gen_basename += f".resolution_{resolution}"
+    gen_basename += f".{quality_bitrate_option}_{quality_bitrate}"
+    gen_basename += f".preset_{preset}"
+    gen_basename += f".rcmode_{rcmode}"
+    enc_basename = gen_basename + CODEC_INFO[codec]["extension"]
+    return os.path.join(tmp_dir, enc_basename)
+
+
 def run_single_enc(
     infile,
     outfile,
@@ -457,119 +1087,56 @@ def run_single_enc(
     preset,
     rcmode,
     gop_length_frames,
+    encoder_threads,
+    reuse_encodes,
     debug,
 ):
     if debug > 0:
-        print("# [%s] encoding file: %s -> %s" % (codec, infile, outfile))
+        print(f"# [{codec}] encoding file: {infile} -> {outfile}")
 
     # get encoding settings
-    enc_tool = "ffmpeg"
-    enc_parms = [
-        "-y",
-    ]
-    enc_parms += ["-i", infile]
-
-    enc_env = None
-    if CODEC_INFO[codec]["codecname"] == "libsvtav1-raw":
-        enc_tool = CODEC_INFO[codec]["binary"]
-        enc_parms = ["-i", infile]
-        # ~/work/video/av1/svt-av1/Bin/Release/SvtAv1EncApp --rc 1 --lp 1 --tbr 14000 --preset 10 --keyint 600 -i /tmp/rdtest_py_tmp/easy.mp4.ref_1728x2304.y4m --output /tmp/rdtest_py_tmp/foo.mp4.ivf
-        if rcmode == "cbr":
-            # TODO(chema): use VBR (1) instead of CBR (2) as SvtAv1EncApp is complaining
-            # Svt[error]: CBR Rate control is currently not supported for SVT_AV1_PRED_RANDOM_ACCESS, use VBR mode
-            # enc_parms += ["--rc", "2"]
-            enc_parms += ["--rc", "1"]
-            bitrate = quality_bitrate
-            enc_parms += ["--tbr", "%s" % bitrate]
-        elif rcmode == "crf":
-            enc_parms += ["--rc", "0"]
-            quality = quality_bitrate
-            enc_parms += ["--crf", "%s" % quality]
-        enc_parms += ["--preset", "%s" % preset]
-        # maximize CPU usage
-        enc_parms += ["--lp", "0"]
-        if gop_length_frames is not None:
-            enc_parms += ["--keyint", str(gop_length_frames)]
-        enc_parms += ["--output", outfile]
-
-    elif CODEC_INFO[codec]["codecname"] == "mjpeg":
-        enc_parms += ["-c:v", CODEC_INFO[codec]["codecname"]]
-        # TODO(chema): use bitrate as quality value (2-31)
-        assert rcmode == "crf", f"error: mjpeg only defined for {rcmode}"
-        quality = quality_bitrate
-        enc_parms += ["-q:v", "%s" % quality]
-        enc_parms += ["-s", resolution]
-    else:
-        enc_parms += ["-c:v", CODEC_INFO[codec]["codecname"]]
-        if rcmode == "cbr":
-            bitrate = quality_bitrate
-            # enc_parms += ["-maxrate", "%sk" % bitrate]
-            # enc_parms += ["-minrate", "%sk" % bitrate]
-            enc_parms += ["-b:v", "%sk" % bitrate]
-            # if CODEC_INFO[codec]["codecname"] in ("libx264", "libopenh264", "libx265"):
-            #    # set bufsize to 2x the bitrate
-            #    bufsize = str(int(bitrate) * 2)
-            #    enc_parms += ["-bufsize", bufsize]
-        elif rcmode == "crf":
-            quality = quality_bitrate
-            enc_parms += ["-crf", "%s" % quality]
-
-        if CODEC_INFO[codec]["codecname"] in ("libx264", "libx265"):
-            # no b-frames
-            enc_parms += ["-bf", "0"]
-        # add preset (if available)
-        if CODEC_INFO[codec].get("preset-name", None) is not None:
-            preset_name = CODEC_INFO[codec].get("preset-name")
-            enc_parms += [f"-{preset_name}", preset]
-        enc_parms += ["-s", resolution]
-        if gop_length_frames is not None:
-            enc_parms += ["-g", str(gop_length_frames)]
-        for k, v in CODEC_INFO[codec]["parameters"].items():
-            enc_parms += ["-%s" % k, str(v)]
-        if CODEC_INFO[codec]["codecname"] in ("libaom-av1",):
-            # ABR at https://trac.ffmpeg.org/wiki/Encode/AV1
-            enc_parms += ["-strict", "experimental"]
+    cmd, enc_env = get_encoder_command(
+        infile,
+        outfile,
+        codec,
+        resolution,
+        quality_bitrate,
+        preset,
+        rcmode,
+        gop_length_frames,
+        encoder_threads,
+    )
 
-    if enc_tool == "ffmpeg":
-        # pass audio through
-        enc_parms += ["-c:a", "copy"]
-        enc_parms += [outfile]
+    # reuse a previous encoding produced by the very same command (the
+    # sidecar file stores the command and the encoder stats)
+    meta_filename = outfile + ".json"
+    if reuse_encodes and os.path.exists(outfile) and os.path.exists(meta_filename):
+        with open(meta_filename) as fin:
+            meta = json.load(fin)
+        if meta["command"] == cmd:
+            if debug > 0:
+                print(f"# [{codec}] reusing encoded file: {outfile}")
+            return meta["stats"]
+    # make sure a stale sidecar never describes a partial encoding
+    if os.path.exists(meta_filename):
+        os.remove(meta_filename)
 
     # run encoder
-    cmd = [
-        enc_tool,
-    ] + enc_parms
     retcode, stdout, stderr, stats = utils.run(
         cmd, env=enc_env, debug=debug, gnu_time=True
     )
     assert retcode == 0, stderr
+    with open(meta_filename, "w") as fout:
+        json.dump({"command": cmd, "stats": stats}, fout)
     return stats
 
 
-def run_single_dec(infile, outfile, codec, debug):
-    if debug > 0:
-        print("# [%s] decoding file: %s -> %s" % (codec, infile, outfile))
-
-    # get decoding settings
-    dec_tool = "ffmpeg"
-    dec_parms = []
-    dec_parms += ["-i", infile]
-    dec_env = None
-    dec_parms += ["-y", outfile]
-
-    # run decoder
-    cmd = [
-        dec_tool,
-    ] + dec_parms
-    retcode, stdout, stderr, _ = utils.run(cmd, env=dec_env, debug=debug)
-    assert retcode == 0, stderr
-
-
 def run_single_experiment(
     ref_filename,
     ref_resolution,
     ref_pix_fmt,
     ref_framerate,
+    ref_duration,
     codec,
     resolution,
     quality_bitrate_option,
@@ -577,28 +1144,32 @@ def run_single_experiment(
     preset,
     rcmode,
     gop_length_frames,
+    encoder_threads,
     tmp_dir,
     debug,
     cleanup,
+    libvmaf_features,
+    vmaf_cuda,
+    reuse_encodes,
 ):
     if debug > 0:
         print(
             f"# [run] run_single_experiment codec: {codec} resolution: {resolution} "
             f"{quality_bitrate_option}: {quality_bitrate} rcmode: {rcmode} preset: {preset}"
         )
-    ref_basename = os.path.basename(ref_filename)
-
-    # common info for enc, dec, and decs
-    gen_basename = ref_basename + f".ref_{ref_resolution}"
-    gen_basename += f".codec_{codec}"
-    gen_basename += f".resolution_{resolution}"
-    gen_basename += f".{quality_bitrate_option}_{quality_bitrate}"
-    gen_basename += f".preset_{preset}"
-    gen_basename += f".rcmode_{rcmode}"
 
     # 3. enc: encode copy with encoder
-    enc_basename = gen_basename + CODEC_INFO[codec]["extension"]
-    enc_filename = os.path.join(tmp_dir, enc_basename)
+    enc_filename = get_encoded_filename(
+        ref_filename,
+        ref_resolution,
+        codec,
+        resolution,
+        quality_bitrate_option,
+        quality_bitrate,
+        preset,
+        rcmode,
+        tmp_dir,
+    )
     encoder_stats = run_single_enc(
         ref_filename,
         enc_filename,
@@ -609,71 +1180,51 @@ def run_single_experiment(
         preset,
         rcmode,
         gop_length_frames,
+        encoder_threads,
+        reuse_encodes,
         debug,
     )
 
-    # 4. dec: decode copy in order to get statistics
-    dec_basename = enc_basename + ".y4m"
-    dec_filename = os.path.join(tmp_dir, dec_basename)
-    run_single_dec(enc_filename, dec_filename, codec, debug)
-
-    # 5. decs: scale the decoded video to the reference resolution and
-    # pixel format
-    # This is needed to make sure the quality metrics make sense
-    decs_basename = dec_basename + ".scaled"
-    decs_basename += ".resolution_%s" % ref_resolution
-    decs_basename += ".y4m"
-    decs_filename = os.path.join(tmp_dir, decs_basename)
+    # 4. dec+decs+metrics: decode the encoded video, scale it to the
+    # reference resolution and pixel format, and get the quality scores,
+    # all in a single ffmpeg run (no intermediate raw files)
+    # Scaling is needed to make sure the quality metrics make sense (but
+    # only if the encoding resolution is not the reference one)
+    scale_filter = f"format={ref_pix_fmt}"
+    if resolution != ref_resolution:
+        ref_width, ref_height = ref_resolution.split("x")
+        scale_filter = f"scale={ref_width}:{ref_height},{scale_filter}"
     if debug > 0:
-        print("# [%s] scaling file: %s -> %s" % (codec, dec_filename, decs_filename))
-    ffmpeg_params = [
-        "-y",
-        "-nostats",
-        "-loglevel",
-        "0",
-        "-i",
-        dec_filename,
-        "-pix_fmt",
-        ref_pix_fmt,
-        "-s",
-        ref_resolution,
-        decs_filename,
-    ]
-    retcode, stdout, stderr, _ = utils.ffmpeg_run(ffmpeg_params, debug)
-    assert retcode == 0, stderr
-    # check produced file matches the requirements
-    assert ref_resolution == utils.get_resolution(
-        decs_filename
-    ), "Error: %s must have resolution: %s (is %s)" % (
-        decs_filename,
-        ref_resolution,
-        utils.get_resolution(decs_filename),
-    )
-    assert ref_pix_fmt == utils.get_pix_fmt(
-        decs_filename
-    ), "Error: %s must have pix_fmt: %s (is %s)" % (
-        decs_filename,
-        ref_pix_fmt,
-        utils.get_pix_fmt(decs_filename),
+        print(f"# [{codec}] scoring file: {enc_filename} (filter: {scale_filter})")
+    psnr_dict, ssim_dict, vmaf_dict = utils.get_metrics(
+        enc_filename,
+        ref_filename,
+        debug,
+        distorted_filter=scale_filter,
+        libvmaf_features=libvmaf_features,
+        threads=encoder_threads,
+        vmaf_cuda=vmaf_cuda,
     )
-
-    # get quality scores
-    psnr_dict = utils.get_psnr(decs_filename, ref_filename, None, debug)
-    ssim_dict = utils.get_ssim(decs_filename, ref_filename, None, debug)
-    vmaf_dict = utils.get_vmaf(decs_filename, ref_filename, None, debug)
-
-    # get actual bitrate
-    actual_bitrate = utils.get_bitrate(enc_filename)
+    # get actual bitrate (no need to probe the encoded file)
+    actual_bitrate = utils.get_bitrate(enc_filename, ref_duration)
 
     # clean up experiments files
-    if cleanup > 0:
-        os.remove(dec_filename)
-        os.remove(decs_filename)
     if cleanup > 1:
         os.remove(enc_filename)
+        os.remove(enc_filename + ".json")
     return encoder_stats, actual_bitrate, psnr_dict, ssim_dict, vmaf_dict
 
 
+def get_number(value):
+    # int if integral (e.g. "10"), float otherwise (e.g. "23.5" for x264
+    # crf), or None if value is not a number
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(value) if value.is_integer() else value
+
+
 def get_options(argv):
     """Generic option parser.
 
@@ -730,6 +1281,23 @@ def get_options(argv):
         help="Do Not Cleanup Files%s"
         % (" [default]" if not default_values["cleanup"] == 0 else ""),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=default_values["jobs"],
+        help="run JOBS experiments in parallel (note that parallel runs "
+        "affect the encoder timing stats) [default: %i]" % default_values["jobs"],
+    )
+    parser.add_argument(
+        "--pin-jobs",
+        action="store_true",
+        dest="pin_jobs",
+        default=default_values["pin_jobs"],
+        help="pin each parallel job to its own set of cores",
+    )
     parser.add_argument(
         "--label",
         action="store",
@@ -757,7 +1325,9 @@ def get_options(argv):
         action="store",
         dest="tmp_dir",
         default=default_values["tmp_dir"],
-        help="use TMP_DIR tmp dir",
+        help="use TMP_DIR tmp dir (a tmpfs dir, e.g. /dev/shm, avoids "
+        "hitting the disk with the raw ref and encoded files) [default: "
+        f"rdtest.<uid> in {SHM_DIR} if mounted, or in the system tmp dir]",
     )
     parser.add_argument(
         "--gop-length",
@@ -773,6 +1343,46 @@ def get_options(argv):
         default=default_values["vmaf_dir"],
         help="use VMAF_DIR vmaf dir",
     )
+    parser.add_argument(
+        "--libvmaf-features",
+        action="store_true",
+        dest="libvmaf_features",
+        default=default_values["libvmaf_features"],
+        help="get PSNR and SSIM from libvmaf features (faster, but SSIM is "
+        "luma-only)",
+    )
+    parser.add_argument(
+        "--vmaf-cuda",
+        action="store_true",
+        dest="vmaf_cuda",
+        default=default_values["vmaf_cuda"],
+        help="compute VMAF in the GPU (requires an ffmpeg with libvmaf_cuda "
+        "support)",
+    )
+    parser.add_argument(
+        "--reuse-encodes",
+        action="store_true",
+        dest="reuse_encodes",
+        default=default_values["reuse_encodes"],
+        help="reuse the encoded files (and encoder stats) left in the tmp "
+        "dir by a previous run with the same encoder command",
+    )
+    parser.add_argument(
+        "--force-ref",
+        action="store_true",
+        dest="force_ref",
+        default=default_values["force_ref"],
+        help="always regenerate the ref files (instead of reusing valid ref "
+        "files left in the tmp dir by a previous run)",
+    )
+    parser.add_argument(
+        "--print-commands",
+        action="store_true",
+        dest="print_commands",
+        default=default_values["print_commands"],
+        help="print the encoder commands (one per line) instead of running "
+        "the experiments",
+    )
     # list of arguments
     parser.add_argument(
         "--codecs",
@@ -833,6 +1443,15 @@ def get_options(argv):
         metavar="output-file",
         help="results file",
     )
+    parser.add_argument(
+        "--output-format",
+        action="store",
+        dest="output_format",
+        choices=OUTPUT_FORMATS,
+        default=default_values["output_format"],
+        help=f"results file format (sqlite writes a {SQLITE_TABLE!r} table) "
+        f"[default: {default_values['output_format']}]",
+    )
     # do the parsing
     options = parser.parse_args(argv[1:])
     # post-process list-based arguments
@@ -853,45 +1472,43 @@ def get_options(argv):
                 elif sep in parameter:
                     vars(options)[field] = parameter.split(sep)
     # check valid values in options.codecs
-    if not all(c in CODEC_INFO.keys() for c in options.codecs):
+    invalid = set(options.codecs) - VALID_CODECS
+    if invalid:
         print(
             "# error: invalid codec(s): %r supported_codecs: %r"
-            % (
-                [c for c in options.codecs if c not in CODEC_INFO.keys()],
-                list(CODEC_INFO.keys()),
-            )
+            % (sorted(invalid), list(CODEC_INFO.keys()))
         )
         sys.exit(-1)
     # check valid values in options.resolutions
-    if not all((r is None or "x" in r) for r in options.resolutions):
-        print(
-            "# error: invalid resolution(s): %r"
-            % ([r for r in options.resolutions if "x" not in r])
-        )
+    invalid = {r for r in options.resolutions if r is not None and "x" not in r}
+    if invalid:
+        print("# error: invalid resolution(s): %r" % sorted(invalid))
         sys.exit(-1)
     # check valid values in options.bitrates
-    if not all((isinstance(b, int) or b.isnumeric()) for b in options.bitrates):
-        print(
-            "# error: invalid bitrate(s): %r"
-            % (
-                [
-                    b
-                    for b in options.bitrates
-                    if not (isinstance(b, int) or b.isnumeric())
-                ]
-            )
-        )
+    invalid = {b for b in options.bitrates if not (isinstance(b, int) or b.isnumeric())}
+    if invalid:
+        print("# error: invalid bitrate(s): %r" % sorted(invalid))
+        sys.exit(-1)
+    # check valid values in options.qualities
+    invalid = {q for q in options.qualities if get_number(q) is None}
+    if invalid:
+        print("# error: invalid quality(ies): %r" % sorted(invalid))
         sys.exit(-1)
     # check valid values in options.rcmodes
-    if not all(r in DEFAULT_RCMODES for r in options.rcmodes):
+    invalid = set(options.rcmodes) - VALID_RCMODES
+    if invalid:
         print(
             "# error: invalid rcmode(s): %r supported_rcmodes: %r"
-            % (
-                [r for r in options.rcmodes if r not in DEFAULT_RCMODES],
-                DEFAULT_RCMODES,
-            )
+            % (sorted(invalid), DEFAULT_RCMODES)
         )
         sys.exit(-1)
+    # libvmaf_cuda cannot provide the libvmaf PSNR/SSIM features
+    if options.vmaf_cuda and options.libvmaf_features:
+        print("# error: --vmaf-cuda and --libvmaf-features are incompatible")
+        sys.exit(-1)
+    # normalize the numeric list-based options once
+    options.bitrates = [int(b) for b in options.bitrates]
+    options.qualities = [get_number(q) for q in options.qualities]
     return options
 
 
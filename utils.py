@@ -6,8 +6,9 @@ import json
 import numpy as np
 import os
 import re
+import shlex
+import signal
 import subprocess
-import sys
 import tempfile
 import time
 
@@ -16,6 +17,16 @@ PERCENTILE_LIST = (0, 5, 10, 25, 75, 90, 95, 100)
 VMAF_MODEL = "/usr/share/model/vmaf_4k_v0.6.1.json"
 VMAF_MODEL = "/usr/share/model/vmaf_v0.6.1.json"
 VMAF_MODEL = "/usr/share/model/vmaf_v0.6.1neg.json"
+# the model is resolved (and checked) once per process
+VMAF_MODEL_CHECKED = False
+
+
+# log parsing regexes (compiled once)
+PERF_INSTR_RE = re.compile(r"(\S+)\s+instructions")
+PERF_CYCLES_RE = re.compile(r"(\S+)\s+cycles:u")
+PERF_TIME_RE = re.compile(r"(\S+)\s+seconds\s+user")
+PSNR_LOG_RE = re.compile(r"psnr_y:(\S+) psnr_u:(\S+) psnr_v:(\S+)")
+SSIM_LOG_RE = re.compile(r"Y:(\S+) U:(\S+) V:(\S+)")
 
 
 # https://gitlab.com/AOMediaCodec/avm/-/blob/main/tools/convexhull_framework/src/Utils.py#L426
@@ -25,13 +36,13 @@ def parse_perf_stats(perfstats_filename):
     enc_cycles = 0
     flog = open(perfstats_filename, "r")
     for line in flog:
-        m = re.search(r"(\S+)\s+instructions", line)
+        m = PERF_INSTR_RE.search(line)
         if m:
             enc_instr = int(m.group(1).replace(",", ""))
-        m = re.search(r"(\S+)\s+cycles:u", line)
+        m = PERF_CYCLES_RE.search(line)
         if m:
             enc_cycles = int(m.group(1).replace(",", ""))
-        m = re.search(r"(\S+)\s+seconds\s+user", line)
+        m = PERF_TIME_RE.search(line)
         if m:
             enc_time = float(m.group(1))
     perf_stats = {
@@ -42,6 +53,14 @@ def parse_perf_stats(perfstats_filename):
     return perf_stats
 
 
+def cancel_on_error(future, future_list):
+    # cancel the futures that have not started yet if "future" failed
+    # (run as a done callback, so before the executor picks the next one)
+    if not future.cancelled() and future.exception() is not None:
+        for pending_future in future_list:
+            pending_future.cancel()
+
+
 def run(command, **kwargs):
     debug = kwargs.get("debug", 0)
     dry_run = kwargs.get("dry_run", False)
@@ -49,13 +68,15 @@ def run(command, **kwargs):
     stdin = subprocess.PIPE if kwargs.get("stdin", False) else None
     bufsize = kwargs.get("bufsize", 0)
     universal_newlines = kwargs.get("universal_newlines", False)
-    default_close_fds = True if sys.platform == "linux2" else False
-    close_fds = kwargs.get("close_fds", default_close_fds)
+    # python fds are not inheritable (PEP 446), so there is no need to
+    # walk and close them all on every launch
+    close_fds = kwargs.get("close_fds", False)
+    timeout = kwargs.get("timeout", None)
     shell = kwargs.get("shell", True)
     get_perf_stats = kwargs.get("get_perf_stats", False)
     gnu_time = kwargs.get("gnu_time", False)
     if type(command) is list:
-        command = subprocess.list2cmdline(command)
+        command = shlex.join(command)
     if debug > 0:
         print(f"running $ {command}")
     if dry_run:
@@ -77,12 +98,21 @@ def run(command, **kwargs):
         env=env,
         close_fds=close_fds,
         shell=shell,
+        # run in its own process group, so that the shell and all its
+        # children can be killed at once
+        start_new_session=True,
     )
     # wait for the command to terminate
-    if stdin is not None:
-        out, err = p.communicate(stdin)
-    else:
-        out, err = p.communicate()
+    try:
+        if stdin is not None:
+            out, err = p.communicate(stdin, timeout=timeout)
+        else:
+            out, err = p.communicate(timeout=timeout)
+    except BaseException:
+        # timeout or interrupt: kill the whole process group
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+        raise
     returncode = p.returncode
     ts2 = time.time()
     # get performance statistics
@@ -156,46 +186,92 @@ def gnu_time_parse(gnu_time_str):
     return gnu_time_stats
 
 
-def ffprobe_run(stream_info, infile, debug=0):
-    cmd = ["ffprobe", "-v", "0", "-of", "csv=s=x:p=0", "-select_streams", "v:0"]
+# ffprobe results, keyed by the probed entries and the file identity
+# (path, size, and mtime), so a rewritten file is probed again
+FFPROBE_CACHE = {}
+
+
+def ffprobe_run(stream_info, infile, debug=0, output_format="csv=s=x:p=0"):
+    try:
+        st = os.stat(infile)
+        key = (
+            stream_info,
+            output_format,
+            os.path.realpath(infile),
+            st.st_size,
+            st.st_mtime_ns,
+        )
+    except (OSError, TypeError):
+        # not a local file: do not cache
+        key = None
+    if key is not None and key in FFPROBE_CACHE:
+        return FFPROBE_CACHE[key]
+    cmd = ["ffprobe", "-v", "0", "-of", output_format, "-select_streams", "v:0"]
     cmd += ["-show_entries", stream_info]
     cmd += [
         infile,
     ]
     retcode, stdout, stderr, _ = run(cmd, debug=debug)
     assert retcode == 0, f"error running {cmd}\nout: {stdout}\nerr: {stderr}"
-    return stdout.decode("ascii").strip()
+    value = stdout.decode("ascii").strip()
+    if key is not None:
+        FFPROBE_CACHE[key] = value
+    return value
+
+
+# no periodic progress lines in the (captured) stderr
+FFMPEG_QUIET_PARAMS = ["-hide_banner", "-nostats"]
 
 
 def ffmpeg_run(params, debug=0):
     cmd = [
         "ffmpeg",
-        "-hide_banner",
+        *FFMPEG_QUIET_PARAMS,
     ] + params
     return run(cmd, debug=debug)
 
 
+# all the entries used by the get_*() helpers below, probed in a single
+# ffprobe run per file ("stream=duration" fails on webm files)
+FFPROBE_INFO_ENTRIES = "stream=width,height,pix_fmt,r_frame_rate:format=duration"
+
+
+def get_info(infile, debug=0):
+    info = json.loads(
+        ffprobe_run(FFPROBE_INFO_ENTRIES, infile, debug, output_format="json")
+    )
+    stream = (info.get("streams") or [{}])[0]
+    return {
+        "resolution": (
+            f"{stream['width']}x{stream['height']}" if "width" in stream else ""
+        ),
+        "pix_fmt": stream.get("pix_fmt", ""),
+        "framerate": stream.get("r_frame_rate", ""),
+        "duration": info.get("format", {}).get("duration", ""),
+    }
+
+
 def get_resolution(infile, debug=0):
-    return ffprobe_run("stream=width,height", infile, debug)
+    return get_info(infile, debug)["resolution"]
 
 
 def get_pix_fmt(infile, debug=0):
-    return ffprobe_run("stream=pix_fmt", infile, debug)
+    return get_info(infile, debug)["pix_fmt"]
 
 
 def get_framerate(infile, debug=0):
-    return ffprobe_run("stream=r_frame_rate", infile, debug)
+    return get_info(infile, debug)["framerate"]
 
 
 def get_duration(infile, debug=0):
-    # "stream=duration" fails on webm files
-    return ffprobe_run("format=duration", infile, debug)
+    return get_info(infile, debug)["duration"]
 
 
-# returns bitrate in kbps
-def get_bitrate(infile):
-    size_bytes = os.stat(infile).st_size
-    in_duration_secs = get_duration(infile)
+# returns bitrate in bps
+# (pass the duration if known to avoid probing the file)
+def get_bitrate(infile, duration=None):
+    size_bytes = os.path.getsize(infile)
+    in_duration_secs = duration if duration is not None else get_duration(infile)
     actual_bitrate = 8.0 * size_bytes / float(in_duration_secs)
     return actual_bitrate
 
@@ -227,16 +303,9 @@ def parse_psnr_log(psnr_log):
         data = fd.read()
     # n:1 mse_avg:2.59 mse_y:3.23 mse_u:1.61 mse_v:1.03 psnr_avg:44.00 psnr_y:43.04 psnr_u:46.07 psnr_v:48.02
     # n:2 mse_avg:3.77 mse_y:4.87 mse_u:1.96 mse_v:1.20 psnr_avg:42.36 psnr_y:41.25 psnr_u:45.22 psnr_v:47.35
-    psnr_values = []
-    for line in data.splitlines():
-        # break line in k:v strings
-        line_items = list(item for item in line.split(" ") if ":" in item)
-        psnr_values.append(
-            {item.split(":")[0]: item.split(":")[1] for item in line_items}
-        )
-    psnr_y_list = np.array(list(float(item["psnr_y"]) for item in psnr_values))
-    psnr_u_list = np.array(list(float(item["psnr_u"]) for item in psnr_values))
-    psnr_v_list = np.array(list(float(item["psnr_v"]) for item in psnr_values))
+    # parse all the lines at once (one row per frame)
+    psnr_values = np.array(PSNR_LOG_RE.findall(data), dtype=float).reshape(-1, 3)
+    psnr_y_list, psnr_u_list, psnr_v_list = psnr_values.T
     psnr_dict = {
         "y_mean": psnr_y_list.mean(),
         "u_mean": psnr_u_list.mean(),
@@ -291,16 +360,9 @@ def parse_ssim_log(ssim_log):
         data = fd.read()
     # n:1 Y:0.985329 U:0.982885 V:0.985790 All:0.984998 (18.238620)
     # n:2 Y:0.979854 U:0.979630 V:0.983818 All:0.980478 (17.094663)
-    ssim_values = []
-    for line in data.splitlines():
-        # break line in k:v strings
-        line_items = list(item for item in line.split(" ") if ":" in item)
-        ssim_values.append(
-            {item.split(":")[0]: item.split(":")[1] for item in line_items}
-        )
-    ssim_y_list = np.array(list(float(item["Y"]) for item in ssim_values))
-    ssim_u_list = np.array(list(float(item["U"]) for item in ssim_values))
-    ssim_v_list = np.array(list(float(item["V"]) for item in ssim_values))
+    # parse all the lines at once (one row per frame)
+    ssim_values = np.array(SSIM_LOG_RE.findall(data), dtype=float).reshape(-1, 3)
+    ssim_y_list, ssim_u_list, ssim_v_list = ssim_values.T
     ssim_dict = {
         "y_mean": ssim_y_list.mean(),
         "u_mean": ssim_u_list.mean(),
@@ -328,6 +390,44 @@ def parse_ssim_log(ssim_log):
     return {f"ssim_{k}": v for k, v in ssim_dict.items()}
 
 
+def is_tmpfs(path):
+    """Check whether path is in a tmpfs.
+
+    Returns None if this cannot be known (no /proc/mounts).
+    """
+    try:
+        with open("/proc/mounts") as fd:
+            mounts = [line.split() for line in fd]
+    except OSError:
+        return None
+    # find the longest mount point containing path
+    path = os.path.realpath(path)
+    fstype = None
+    mount_point_len = -1
+    for _, mount_point, mount_fstype, *_ in mounts:
+        if (
+            path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        ) and len(mount_point) > mount_point_len:
+            fstype = mount_fstype
+            mount_point_len = len(mount_point)
+    return fstype == "tmpfs"
+
+
+def ffmpeg_supports_filters(filter_list, debug):
+    ffmpeg_params = [
+        "-filters",
+    ]
+    retcode, stdout, stderr, _ = ffmpeg_run(ffmpeg_params, debug)
+    assert retcode == 0, stderr
+    # filter lines look like " ... libvmaf_cuda      VV->V      Calculate..."
+    supported_filters = {
+        line.split()[1]
+        for line in stdout.decode("ascii").splitlines()
+        if len(line.split()) > 2
+    }
+    return all(name in supported_filters for name in filter_list)
+
+
 def ffmpeg_supports_libvmaf(debug):
     libvmaf_support = False
     ffmpeg_params = [
@@ -341,15 +441,43 @@ def ffmpeg_supports_libvmaf(debug):
     return libvmaf_support
 
 
-def check_software(debug):
+# set once the software check passes (child processes, and sweep scripts
+# that export it, skip the check)
+PREFLIGHT_ENV = "RDTEST_PREFLIGHT_OK"
+
+
+def check_software(debug, vmaf_cuda=False):
+    if vmaf_cuda:
+        # ensure ffmpeg supports the cuda vmaf filters
+        assert ffmpeg_supports_filters(
+            ("hwupload_cuda", "libvmaf_cuda"), debug
+        ), "error: ffmpeg does not support libvmaf_cuda (or hwupload_cuda)"
+    if os.environ.get(PREFLIGHT_ENV) == "1":
+        return
     # ensure ffmpeg supports libvmaf
     libvmaf_support = ffmpeg_supports_libvmaf(debug)
     assert libvmaf_support, "error: ffmpeg does not support vmaf"
+    os.environ[PREFLIGHT_ENV] = "1"
 
 
-def get_vmaf(distorted_filename, ref_filename, vmaf_json, debug):
-    global VMAF_MODEL
+def get_vmaf_model():
+    global VMAF_MODEL, VMAF_MODEL_CHECKED
 
+    if VMAF_MODEL_CHECKED:
+        return VMAF_MODEL
+    VMAF_MODEL_CHECKED = True
+    # Allow for an environment variable pointing out the VMAF model
+    if os.environ.get("VMAF_MODEL_PATH", None):
+        print("Environment VMAF_PATH override model")
+        VMAF_MODEL = os.environ.get("VMAF_MODEL_PATH")
+    if not os.path.isfile(VMAF_MODEL):
+        print(
+            f"\n***\nwarn: cannot find VMAF model {VMAF_MODEL}. Using default model\n***"
+        )
+    return VMAF_MODEL
+
+
+def get_vmaf(distorted_filename, ref_filename, vmaf_json, debug):
     vmaf_json = (
         vmaf_json
         if vmaf_json is not None
@@ -359,15 +487,7 @@ def get_vmaf(distorted_filename, ref_filename, vmaf_json, debug):
     # important: vmaf must be called with videos in the right order
     # <distorted_video> <reference_video>
     # https://jina-liu.medium.com/a-practical-guide-for-vmaf-481b4d420d9c
-
-    # Allow for an environment variable pointing out the VMAF model
-    if os.environ.get("VMAF_MODEL_PATH", None):
-        print("Environment VMAF_PATH override model")
-        VMAF_MODEL = os.environ.get("VMAF_MODEL_PATH")
-    if not os.path.isfile(VMAF_MODEL):
-        print(
-            f"\n***\nwarn: cannot find VMAF model {VMAF_MODEL}. Using default model\n***"
-        )
+    VMAF_MODEL = get_vmaf_model()
 
     ffmpeg_params = [
         "-i",
@@ -406,3 +526,167 @@ def parse_vmaf_output(vmaf_json, vmaf_model):
         }
     )
     return {f"vmaf_{k}": v for k, v in vmaf_dict.items()}
+
+
+def get_metrics(
+    distorted_filename,
+    ref_filename,
+    debug,
+    distorted_filter=None,
+    libvmaf_features=False,
+    threads=None,
+    vmaf_cuda=False,
+):
+    """Get the PSNR, SSIM, and VMAF scores in a single ffmpeg run.
+
+    Both videos are decoded once and split into the psnr, ssim, and
+    libvmaf filters. If set, distorted_filter (e.g. a scale/format chain)
+    is applied to the distorted video before the split. Returns the same
+    dictionaries as get_psnr(), get_ssim(), and get_vmaf().
+
+    If libvmaf_features is set, PSNR and SSIM are instead computed by
+    libvmaf itself (psnr and float_ssim features), sharing its frame
+    reads. Note that libvmaf only provides the luma SSIM.
+
+    If set, threads caps the decoder, filter graph, and libvmaf threads
+    (e.g. to avoid oversubscription when running several experiments in
+    parallel).
+
+    If vmaf_cuda is set, VMAF is computed in the GPU (libvmaf_cuda): both
+    videos are still decoded and filtered in the CPU (so PSNR and SSIM do
+    not change), and uploaded to the GPU only for the libvmaf_cuda filter.
+    """
+    if libvmaf_features:
+        return get_metrics_libvmaf(
+            distorted_filename, ref_filename, debug, distorted_filter, threads
+        )
+    psnr_log = tempfile.NamedTemporaryFile(prefix="psnr.", suffix=".log").name
+    ssim_log = tempfile.NamedTemporaryFile(prefix="ssim.", suffix=".log").name
+    vmaf_json = tempfile.NamedTemporaryFile(prefix="vmaf.", suffix=".json").name
+    vmaf_model = get_vmaf_model()
+    # important: vmaf must be called with videos in the right order
+    # <distorted_video> <reference_video>
+    distorted_prefix = "" if distorted_filter is None else f"{distorted_filter},"
+    if vmaf_cuda:
+        vmaf_filter = (
+            "[dist2]hwupload_cuda[dist2cuda];[ref2]hwupload_cuda[ref2cuda];"
+            f"[dist2cuda][ref2cuda]libvmaf_cuda=model=path={vmaf_model}"
+            f":log_fmt=json:log_path={vmaf_json}"
+        )
+    else:
+        vmaf_filter = (
+            f"[dist2][ref2]libvmaf=model=path={vmaf_model}"
+            f":log_fmt=json:log_path={vmaf_json}{get_libvmaf_threads(threads)}"
+        )
+    filter_complex = (
+        f"[0:v]{distorted_prefix}split=3[dist0][dist1][dist2];"
+        "[1:v]split=3[ref0][ref1][ref2];"
+        f"[dist0][ref0]psnr=stats_file={psnr_log};"
+        f"[dist1][ref1]ssim=stats_file={ssim_log};"
+        f"{vmaf_filter}"
+    )
+    ffmpeg_params = get_metrics_params(
+        distorted_filename, ref_filename, filter_complex, threads
+    )
+    retcode, _, stderr, _ = ffmpeg_run(ffmpeg_params, debug)
+    assert retcode == 0, stderr
+    psnr_dict = parse_psnr_log(psnr_log)
+    ssim_dict = parse_ssim_log(ssim_log)
+    vmaf_dict = parse_vmaf_output(vmaf_json, vmaf_model)
+    return psnr_dict, ssim_dict, vmaf_dict
+
+
+# y4m headers fully describe the (raw) video stream, so there is no need to
+# read (and decode) packets to find the stream info
+FFMPEG_Y4M_INPUT_PARAMS = ["-probesize", "32", "-analyzeduration", "0"]
+
+
+def get_input_params(infile):
+    if os.path.splitext(infile)[1].lower() == ".y4m":
+        return FFMPEG_Y4M_INPUT_PARAMS
+    return []
+
+
+def get_metrics_params(distorted_filename, ref_filename, filter_complex, threads):
+    thread_params = [] if threads is None else ["-threads", str(threads)]
+    filter_thread_params = (
+        [] if threads is None else ["-filter_complex_threads", str(threads)]
+    )
+    return [
+        *filter_thread_params,
+        *thread_params,
+        "-i",
+        distorted_filename,
+        *thread_params,
+        *get_input_params(ref_filename),
+        "-i",
+        ref_filename,
+        "-filter_complex",
+        filter_complex,
+        "-f",
+        "null",
+        "-",
+    ]
+
+
+def get_libvmaf_threads(threads):
+    return "" if threads is None else f":n_threads={threads}"
+
+
+def get_metrics_libvmaf(
+    distorted_filename, ref_filename, debug, distorted_filter, threads=None
+):
+    vmaf_json = tempfile.NamedTemporaryFile(prefix="vmaf.", suffix=".json").name
+    vmaf_model = get_vmaf_model()
+    distorted_prefix = "" if distorted_filter is None else f"{distorted_filter},"
+    filter_complex = (
+        f"[0:v]{distorted_prefix}null[dist];"
+        f"[dist][1:v]libvmaf=model=path={vmaf_model}"
+        ":feature=name=psnr|name=float_ssim"
+        f":log_fmt=json:log_path={vmaf_json}"
+        f"{get_libvmaf_threads(threads)}"
+    )
+    ffmpeg_params = get_metrics_params(
+        distorted_filename, ref_filename, filter_complex, threads
+    )
+    retcode, _, stderr, _ = ffmpeg_run(ffmpeg_params, debug)
+    assert retcode == 0, stderr
+    psnr_dict, ssim_dict = parse_vmaf_features(vmaf_json)
+    vmaf_dict = parse_vmaf_output(vmaf_json, vmaf_model)
+    return psnr_dict, ssim_dict, vmaf_dict
+
+
+def parse_vmaf_features(vmaf_json):
+    """Parse the libvmaf psnr and float_ssim per-frame features"""
+    with open(vmaf_json) as fd:
+        data = json.load(fd)
+    frame_metrics = [frame["metrics"] for frame in data["frames"]]
+    psnr_dict = get_stats_dict(
+        {
+            "y": np.array(list(m["psnr_y"] for m in frame_metrics)),
+            "u": np.array(list(m["psnr_cb"] for m in frame_metrics)),
+            "v": np.array(list(m["psnr_cr"] for m in frame_metrics)),
+        }
+    )
+    ssim_dict = get_stats_dict(
+        {
+            "y": np.array(list(m["float_ssim"] for m in frame_metrics)),
+        }
+    )
+    return (
+        {f"psnr_{k}": v for k, v in psnr_dict.items()},
+        {f"ssim_{k}": v for k, v in ssim_dict.items()},
+    )
+
+
+def get_stats_dict(values_dict):
+    # same layout as parse_psnr_log(): all the means, then the percentiles
+    stats_dict = {f"{k}_mean": v.mean() for k, v in values_dict.items()}
+    for k, v in values_dict.items():
+        stats_dict.update(
+            {
+                f"{k}_p{percentile}": np.percentile(v, percentile)
+                for percentile in PERCENTILE_LIST
+            }
+        )
+    return stats_dict